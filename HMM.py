@@ -1,7 +1,22 @@
 import random
 import argparse
+import asyncio
 import codecs
+import collections
+import concurrent.futures
+import contextlib
+import errno
+import hashlib
+import itertools
+import json
+import multiprocessing
 import os
+import shutil
+import socket
+import stat
+import sys
+import tempfile
+import time
 import numpy as np
 
 # Sequence - represents a sequence of hidden states and corresponding
@@ -18,9 +33,1251 @@ class Sequence:
     def __len__(self):
         return len(self.outputseq)
 
+# Vocabulary - the output names of a model, indexed 0..V-1. The names are
+# kept as one fixed-width bytes array. Lookups go through a dict of the
+# encoded names, except in a model memory-mapped from the binary cache,
+# which binary searches a sorted copy of the names stored with it instead
+# of building that dict.
+
+class Vocabulary:
+    def __init__(self, names, index=None, sorted_names=None, order=None):
+        self.names = names            # utf-8 encoded names, numpy 'S' dtype
+        if index is None and sorted_names is None:
+            index = dict(zip(names.tolist(), range(len(names))))
+        self._index = index           # encoded name -> index, or None to search _sorted
+        self._sorted = sorted_names   # the names in ascending order
+        self._order = order           # index of each sorted name
+        self._memo = {}               # names found so far -> index
+
+    @classmethod
+    def from_names(cls, names):
+        """builds a Vocabulary from a list of strings."""
+        return cls(np.array([name.encode('utf-8') for name in names], dtype='S'))
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, i):
+        return self.names[i].decode('utf-8')
+
+    def __iter__(self):
+        return (name.decode('utf-8') for name in self.names)
+
+    def __contains__(self, name):
+        return self.get(name) >= 0
+
+    def get(self, name, default=-1):
+        """returns the index of name, or default if it isn't in the vocabulary."""
+        index = self._memo.get(name)
+        if index is not None:
+            return index
+        encoded = name.encode('utf-8')
+        if self._index is not None:
+            index = self._index.get(encoded)
+        else:
+            k = int(np.searchsorted(self._sorted, encoded))
+            if k < len(self._sorted) and self._sorted[k] == encoded:
+                index = int(self._order[k])
+        # 'S' arrays drop trailing NULs, so names ending in one aren't in here
+        if index is None or encoded.endswith(b'\0'):
+            return default
+        self._memo[name] = index
+        return index
+
+    def sorted_table(self):
+        """(the names in ascending order, the index of each), as stored in
+        the binary cache."""
+        if self._sorted is None:
+            self._order = np.argsort(self.names, kind='stable')
+            self._sorted = self.names[self._order]
+        return self._sorted, self._order
+
+    def index(self, name):
+        i = self.get(name)
+        if i < 0:
+            raise ValueError(f"{name!r} is not in the vocabulary")
+        return i
+
+    def encode(self, names):
+        """returns the index of each name, or -1 for names not in the vocabulary."""
+        return np.fromiter((self.get(name) for name in names), dtype=np.intp, count=len(names))
+
+# Bulk reader for .trans/.emit files. The file is read in chunks of whole
+# lines; each chunk is split into tokens in one call, the probabilities
+# converted in one pass, and the names numbered through a dict of the
+# distinct names, so no per-line dicts are built.
+
+def _chunks(f, chunk_size):
+    """yields a binary file in chunks that end on a line boundary."""
+    rest = b''
+    while True:
+        block = f.read(chunk_size)
+        if not block:
+            break
+        block = rest + block
+        cut = block.rfind(b'\n') + 1
+        rest = block[cut:]
+        if block[:cut].strip():
+            yield block[:cut]
+    if rest.strip():
+        yield rest + b'\n'
+
+def _triples(chunk):
+    """the (first names, second names, probabilities) of a chunk of lines."""
+    tokens = chunk.split()
+    if len(tokens) == 3 * chunk.count(b'\n'):
+        return tokens[0::3], tokens[1::3], tokens[2::3]
+    # Blank lines, or several 'name probability' pairs on a line
+    first, second, probabilities = [], [], []
+    for line in chunk.splitlines():
+        parts = line.split()
+        for i in range(1, len(parts), 2):
+            first.append(parts[0])
+            second.append(parts[i])
+            probabilities.append(parts[i + 1])
+    return first, second, probabilities
+
+def _number(names, index):
+    """the ids of names, adding the new ones to index (name -> id) in
+    order of first appearance."""
+    fresh = [name for name in dict.fromkeys(names) if name not in index]
+    index.update(zip(fresh, range(len(index), len(index) + len(fresh))))
+    return np.fromiter(map(index.__getitem__, names), dtype=np.intp, count=len(names))
+
+def read_triples(filename, chunk_size=1 << 18):
+    """reads a .trans or .emit file in chunks without building a dict per line.
+    Returns (first, second, probabilities), where first and second are
+    (ids, dict of the distinct names as bytes -> id, row each first appears
+    on) for the two name columns."""
+    first, second = {}, {}
+    first_ids, second_ids, probabilities = [], [], []
+    with open(filename, "rb") as f:
+        for chunk in _chunks(f, chunk_size):
+            a, b, p = _triples(chunk)
+            first_ids.append(_number(a, first))
+            second_ids.append(_number(b, second))
+            probabilities.append(np.fromiter(map(float, p), dtype=np.float64, count=len(p)))
+
+    def column(ids, index):
+        ids = np.concatenate(ids) if ids else np.zeros(0, dtype=np.intp)
+        # Ids go up in order of first appearance
+        return ids, index, np.unique(ids, return_index=True)[1]
+    return (column(first_ids, first), column(second_ids, second),
+            np.concatenate(probabilities) if probabilities else np.zeros(0))
+
+def read_table(filename):
+    """reads a .trans or .emit file into a dict of dicts of (string) probabilities."""
+    table = {}
+    with open(filename, "r") as f:
+        for line in f:
+            parts = line.strip().split()
+            state = parts[0]
+            if state not in table:
+                table[state] = {}
+            for i in range(1, len(parts), 2):
+                output = parts[i]
+                probability = parts[i + 1]
+                table[state][output] = probability  # keep as string if needed
+    return table
+
+def read_sentences(filename):
+    """yields the sentences of an .obs file as lists of observations.
+    Sentences are separated by blank lines, as in ambiguous_sents.obs."""
+    sentence = []
+    with open(filename, "r") as f:
+        for line in f:
+            words = line.split()
+            if words:
+                sentence.extend(words)
+            elif sentence:
+                yield sentence
+                sentence = []
+    if sentence:
+        yield sentence
+
+# Binary model cache. CompiledModel.load_cached keeps each model's arrays as
+# .npy files in basename.hmmc/<build>/<dtype>/ and memory-maps them on later
+# loads, so every process using a model shares the same pages; float32 and
+# float64 loads each get their own copy. basename.hmmc/index.json
+# records the size and mtime of the text files the current build came from;
+# when those change, the build is looked up by a sha1 of the file contents.
+
+_CACHE_VERSION = 3
+_CACHED_ARRAYS = ('pi', 'A', 'B', 'log_pi', 'log_A', 'log_B')
+
+def _source_stats(basename):
+    """returns [size, mtime] of basename.trans and basename.emit."""
+    stats = {}
+    for ext in ('trans', 'emit'):
+        st = os.stat(f"{basename}.{ext}")
+        stats[ext] = [st.st_size, st.st_mtime_ns]
+    return stats
+
+def _source_digest(basename):
+    """names a cache build after the contents of the text files."""
+    digest = hashlib.sha1(f"hmmc{_CACHE_VERSION}".encode())
+    for ext in ('trans', 'emit'):
+        digest.update(f"{ext}:{os.path.getsize(f'{basename}.{ext}')}:".encode())
+        with open(f"{basename}.{ext}", "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+    return digest.hexdigest()[:16]
+
+def _read_model(basename):
+    """reads basename.trans and basename.emit into index form: returns
+    (states, vocab, (start states, p), (rows, cols, p), (states, outputs, p))
+    for the start, transition and emission probabilities."""
+    (source, sources, source_rows), (target, targets, target_rows), p = read_triples(f"{basename}.trans")
+    (emitter, emitters, _), (output, outputs, _), q = read_triples(f"{basename}.emit")
+    sources, targets, emitters = ([name.decode('utf-8') for name in names] for names in (sources, targets, emitters))
+    vocab = Vocabulary(np.array(list(outputs), dtype='S'), outputs)
+
+    # Hidden states by first appearance: each line's source, then its target
+    first_seen = {}
+    for name, row in zip(targets, target_rows):
+        first_seen[name] = 2 * int(row) + 1
+    for name, row in zip(sources, source_rows):
+        first_seen[name] = min(2 * int(row), first_seen.get(name, 2 * int(row)))
+    first_seen.pop('#', None)
+    state_index = {s: i for i, s in enumerate(sorted(first_seen, key=first_seen.get))}
+    for s in emitters:
+        state_index.setdefault(s, len(state_index))
+
+    # Map each file's local name ids onto the state indices; '#' becomes -1
+    rows = np.array([state_index.get(s, -1) for s in sources], dtype=np.intp)[source]
+    cols = np.array([state_index[s] for s in targets], dtype=np.intp)[target]
+    start = rows < 0
+    emitter = np.array([state_index[s] for s in emitters], dtype=np.intp)[emitter]
+    return (list(state_index), vocab, (cols[start], p[start]),
+            (rows[~start], cols[~start], p[~start]), (emitter, output, q))
+
+# CompiledModel - the numeric form of an HMM: integer-indexed states and
+# outputs, with the start (pi), transition (A) and emission (B) probabilities
+# stored as dense arrays. The start state '#' is folded into pi.
+
+# Every model object gets its own key, never reused, so results cached for
+# one model can't be mistaken for another's (see DecodeCache).
+_model_keys = itertools.count()
+
+class CompiledModel:
+    def __init__(self, states, vocab, pi, A, B):
+        self.key = next(_model_keys)
+        self.states = states        # index -> hidden state name
+        self.vocab = vocab          # Vocabulary, index <-> output name
+        self.state_index = {s: i for i, s in enumerate(states)}
+        self.pi = pi                # (S,)   P(state | '#')
+        self.A = A                  # (S, S) P(next state | state)
+        self.B = B                  # (S, V) P(output | state)
+        self.unknown = None         # UnknownWords for unseen outputs, if any
+        self._logs = None
+
+    # Log-space copies so long sequences don't underflow to zero.
+    # Built the first time an algorithm needs them.
+    def _log_arrays(self):
+        if self._logs is None:
+            with np.errstate(divide='ignore'):
+                self._logs = np.log(self.pi), np.log(self.A), np.log(self.B)
+        return self._logs
+
+    @property
+    def log_pi(self):
+        return self._log_arrays()[0]
+
+    @property
+    def log_A(self):
+        return self._log_arrays()[1]
+
+    @property
+    def log_B(self):
+        return self._log_arrays()[2]
+
+    @classmethod
+    def from_dicts(cls, transitions, emissions, dtype=np.float64):
+        """builds the arrays from HMM-style dicts of (string) probabilities."""
+        # Hidden states in the order they first appear, without the start state '#'
+        state_index = {}
+        for s, row in transitions.items():
+            for name in [s] + list(row):
+                if name != '#':
+                    state_index.setdefault(name, len(state_index))
+        for s in emissions:
+            state_index.setdefault(s, len(state_index))
+
+        vocab_index = {}
+        for row in emissions.values():
+            for output in row:
+                vocab_index.setdefault(output, len(vocab_index))
+
+        num_states = len(state_index)
+        pi = np.zeros(num_states, dtype=dtype)
+        A = np.zeros((num_states, num_states), dtype=dtype)
+        B = np.zeros((num_states, len(vocab_index)), dtype=dtype)
+        for s, row in transitions.items():
+            for next_state, probability in row.items():
+                if s == '#':
+                    pi[state_index[next_state]] = float(probability)
+                else:
+                    A[state_index[s], state_index[next_state]] = float(probability)
+        for s, row in emissions.items():
+            for output, probability in row.items():
+                B[state_index[s], vocab_index[output]] = float(probability)
+        return cls(list(state_index), Vocabulary.from_names(list(vocab_index)), pi, A, B)
+
+    @classmethod
+    def load(cls, basename, dtype=np.float64):
+        """builds the arrays straight from basename.trans and basename.emit."""
+        states, vocab, p_start, (rows, cols, p), (emitters, outputs, q) = _read_model(basename)
+        pi = np.zeros(len(states), dtype=dtype)
+        A = np.zeros((len(states), len(states)), dtype=dtype)
+        B = np.zeros((len(states), len(vocab)), dtype=dtype)
+        pi[p_start[0]] = p_start[1]
+        A[rows, cols] = p
+        B[emitters, outputs] = q
+        return cls(states, vocab, pi, A, B)
+
+    @classmethod
+    def load_cached(cls, basename, dtype=np.float64):
+        """like load, but through the binary cache in basename.hmmc, which
+        is (re)built whenever the contents of the text files change."""
+        cache = f"{basename}.hmmc"
+        stats = _source_stats(basename)
+        try:
+            with open(os.path.join(cache, "index.json")) as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            index = {}
+        if index.get('version') == _CACHE_VERSION and index.get('sources') == stats:
+            build = index['build']
+        else:
+            # Sizes or mtimes changed: only rebuild if the contents did too
+            build = _source_digest(basename)
+        directory = os.path.join(cache, build, np.dtype(dtype).name)
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(os.path.dirname(directory), exist_ok=True)
+                # Build in a private directory and rename it into place, so
+                # other processes never see half-written arrays
+                staging = tempfile.mkdtemp(prefix=".build-", dir=cache)
+                cls.load(basename, dtype).save(staging)
+                try:
+                    os.rename(staging, directory)
+                except OSError:
+                    shutil.rmtree(staging, ignore_errors=True)  # someone else got there first
+            if index.get('build') != build or index.get('sources') != stats:
+                fd, staging = tempfile.mkstemp(prefix=".index-", dir=cache)
+                with os.fdopen(fd, "w") as f:
+                    json.dump({'version': _CACHE_VERSION, 'build': build, 'sources': stats}, f)
+                os.replace(staging, os.path.join(cache, "index.json"))
+                # Old builds stay readable by processes that still map them
+                for entry in os.listdir(cache):
+                    if entry != build and not entry.startswith('.') and entry != "index.json":
+                        shutil.rmtree(os.path.join(cache, entry), ignore_errors=True)
+        except OSError:
+            # Can't write next to the text files: just parse them
+            return cls.load(basename, dtype)
+        return cls.open(directory, dtype)
+
+    def save(self, directory):
+        """writes the model as .npy files that open() can memory-map."""
+        os.makedirs(directory, exist_ok=True)
+        for name in _CACHED_ARRAYS:
+            np.save(os.path.join(directory, f"{name}.npy"), getattr(self, name))
+        np.save(os.path.join(directory, "states.npy"), np.array([s.encode('utf-8') for s in self.states], dtype='S'))
+        np.save(os.path.join(directory, "vocab.npy"), self.vocab.names)
+        sorted_names, order = self.vocab.sorted_table()
+        np.save(os.path.join(directory, "vocab_sorted.npy"), sorted_names)
+        np.save(os.path.join(directory, "vocab_order.npy"), order)
+
+    @classmethod
+    def open(cls, directory, dtype=np.float64):
+        """memory-maps a model written by save(). Asking for a different
+        dtype than was saved makes private (unmapped) copies of the arrays."""
+        def array(name):
+            return np.load(os.path.join(directory, f"{name}.npy"), mmap_mode='r')
+
+        arrays = {name: array(name) for name in _CACHED_ARRAYS}
+        if arrays['A'].dtype != np.dtype(dtype):
+            arrays = {name: np.array(a, dtype=dtype) for name, a in arrays.items()}
+        states = [s.decode('utf-8') for s in array("states").tolist()]
+        vocab = Vocabulary(array("vocab"), None, array("vocab_sorted"), array("vocab_order"))
+        model = cls(states, vocab, arrays['pi'], arrays['A'], arrays['B'])
+        model._logs = arrays['log_pi'], arrays['log_A'], arrays['log_B']
+        return model
+
+    def to_dicts(self):
+        """the model as HMM-style (transitions, emissions) dicts of strings,
+        leaving out zero probabilities."""
+        def row(probabilities, names):
+            return {names[i]: repr(float(probabilities[i])) for i in np.flatnonzero(probabilities)}
+
+        transitions = {'#': row(self.pi, self.states)}
+        emissions = {}
+        for i, s in enumerate(self.states):
+            transitions[s] = row(self.A[i], self.states)
+            emissions[s] = row(self.B[i], self.vocab)
+        return transitions, emissions
+
+    def with_outputs(self, names):
+        """a copy of this model whose vocabulary also has the given outputs,
+        each starting at probability 1/V from every state (rows renormalized),
+        so Baum-Welch has something to learn them from."""
+        new = [name for name in dict.fromkeys(names) if name not in self.vocab]
+        if not new:
+            return self
+        vocab = Vocabulary.from_names(list(self.vocab) + new)
+        B = np.hstack([self.B, np.full((len(self.states), len(new)), 1.0 / len(vocab), dtype=self.B.dtype)])
+        B /= B.sum(axis=1, keepdims=True)
+        return CompiledModel(self.states, vocab, np.array(self.pi), np.array(self.A), B)
+
+    def emission_column(self, column):
+        """P(output | state) for every state, given the output's column;
+        all zeros for -1."""
+        if column < 0:
+            return np.zeros(len(self.states), dtype=self.B.dtype)
+        if column >= len(self.vocab):
+            return self.unknown.F[column - len(self.vocab)]
+        return self.B[:, column]
+
+    def column(self, output):
+        """the vocabulary index of one output. Unseen outputs get
+        UnknownWords.column if the model has those, else -1."""
+        column = self.vocab.get(output)
+        if column < 0 and self.unknown is not None:
+            column = self.unknown.column(output, self.vocab)
+        return column
+
+    def encode(self, sequence):
+        """returns column(output) for each output of sequence."""
+        columns = self.vocab.encode(sequence)
+        if self.unknown is not None:
+            for i in np.flatnonzero(columns < 0):
+                columns[i] = self.unknown.column(sequence[i], self.vocab)
+        return columns
+
+    def log_emissions(self, sequence):
+        """returns a (len(sequence), num_states) array of log emission probabilities.
+        Outputs that no state emits get -inf for every state."""
+        return self.log_emission_rows(self.encode(sequence))
+
+    def log_emission_rows(self, columns):
+        """like log_emissions, for an array of vocabulary indices of any
+        shape; the states become a new last axis."""
+        E = np.full(columns.shape + (len(self.states),), -np.inf)
+        known = (columns >= 0) & (columns < len(self.vocab))
+        E[known] = self.log_B[:, columns[known]].T
+        if self.unknown is not None:
+            unseen = columns >= len(self.vocab)
+            E[unseen] = self.unknown.log_F[columns[unseen] - len(self.vocab)]
+        return E
+
+# UnknownWords - emission probabilities for outputs a model has never seen.
+# Every vocabulary word is filed under its shape (capitalization, digits,
+# punctuation) and under each suffix of up to max_suffix letters within
+# that shape. Unseen words behave like the rare words of a state, not its
+# frequent ones (a new word ending in -or is hardly ever a conjunction), so
+# only each state's rare words count: those it emits with at most rare times
+# its smallest probability, which is what one occurrence in the training
+# counts was. The fallback for a class is the emission mass of its rare words
+# under each state, per word of the class, smoothed towards the next shorter
+# suffix (and finally the whole vocabulary) with a pseudo-count of strength
+# words. An unseen word takes the vector of its longest known class, found
+# with at most max_suffix + 1 dict probes.
+
+def _word_shape(word):
+    """the coarse shape of a word: digits, capitalization and the like."""
+    if word.isdigit():
+        return 'digits'
+    if any(c.isdigit() for c in word):
+        return 'has-digit'
+    if not any(c.isalpha() for c in word):
+        return 'punct'
+    if word.isupper():
+        return 'upper'
+    if word[0].isupper():
+        return 'capitalized'
+    if '-' in word:
+        return 'hyphen'
+    return 'lower'
+
+class UnknownWords:
+    def __init__(self, keys, F, max_suffix=3):
+        self.keys = keys            # (shape, suffix) -> row of F; suffix '' for the shape alone
+        self.F = F                  # (classes + 1, S) P(unseen output | state); the last row is global
+        self.max_suffix = max_suffix
+        with np.errstate(divide='ignore'):
+            self.log_F = np.log(F)
+
+    @classmethod
+    def from_model(cls, model, max_suffix=3, strength=5.0, rare=2):
+        """precomputes the fallback vectors from a model's emission table,
+        dense or sparse, going only through its nonzeros."""
+        num_states = len(model.states)
+        if isinstance(model, SparseModel):
+            B = model.B_csc
+            rows, cols, values = B.indices, np.repeat(np.arange(B.shape[1]), np.diff(B.indptr)), B.data
+        else:
+            rows, cols = np.nonzero(model.B)
+            values = model.B[rows, cols]
+        values = values.astype(np.float64)
+        smallest = np.full(num_states, np.inf)
+        np.minimum.at(smallest, rows, values)
+        keep = values <= rare * smallest[rows] * (1 + 1e-9)
+        rows, cols, values = rows[keep], cols[keep], values[keep]
+        words = list(model.vocab)
+        shapes = [_word_shape(w) for w in words]
+        lengths = np.array([len(w) for w in words], dtype=np.intp)
+        keys = {}
+        levels = []  # (class of each word, words long enough) per suffix length
+        for length in range(max_suffix + 1):
+            long_enough = lengths >= length
+            levels.append((np.array([keys.setdefault((shape, w[-length:] if length else ''), len(keys))
+                                     if ok else -1 for w, shape, ok in zip(words, shapes, long_enough)], dtype=np.intp),
+                           long_enough))
+        num_classes = len(keys)
+
+        # Smooth each class towards its parent, shortest suffixes first; the
+        # parent of a shape alone is the last row, the whole vocabulary
+        F = np.zeros((num_classes + 1, num_states))
+        F[-1] = np.bincount(rows, weights=values, minlength=num_states) / max(len(words), 1)
+        parents = np.full(len(words), num_classes)
+        for classes, long_enough in levels:
+            members = classes[long_enough]
+            sizes = np.bincount(members, minlength=num_classes)
+            counted = long_enough[cols]
+            sums = np.bincount(classes[cols[counted]] * num_states + rows[counted], weights=values[counted],
+                               minlength=num_classes * num_states).reshape(num_classes, num_states)
+            parent = np.full(num_classes, num_classes)
+            parent[members] = parents[long_enough]
+            present = np.flatnonzero(sizes)
+            F[present] = (sums[present] + strength * F[parent[present]]) / (sizes[present, None] + strength)
+            parents = np.where(long_enough, classes, parents)
+        return cls(keys, F, max_suffix)
+
+    def column(self, word, vocab):
+        """the emission column for an unseen word: its lowercase form's if
+        that is in vocab, else len(vocab) + its row of F."""
+        if word.lower() != word:
+            column = vocab.get(word.lower())
+            if column >= 0:
+                return column
+        return len(vocab) + self.row(word)
+
+    def row(self, word):
+        """the row of F to use for an unseen word. A vocabulary without a
+        word of its shape (say, nothing capitalized) files it lowercased."""
+        shape = _word_shape(word)
+        if (shape, '') not in self.keys and word.lower() != word:
+            word = word.lower()
+            shape = _word_shape(word)
+        for length in range(min(self.max_suffix, len(word)), 0, -1):
+            row = self.keys.get((shape, word[-length:]))
+            if row is not None:
+                return row
+        return self.keys.get((shape, ''), len(self.F) - 1)
+
+# Sparse storage. In the part-of-speech model each tag emits only a small
+# slice of the vocabulary, so a dense S x V emission table is mostly zeros.
+# SparseModel keeps the transition and emission tables column-compressed
+# (CSC): the nonzeros of column j are data[indptr[j]:indptr[j+1]], in rows
+# indices[indptr[j]:indptr[j+1]]. Columns of B are outputs, so the states
+# that can emit a word are one slice away; columns of A are next states,
+# holding the states that can precede them.
+
+class CSCMatrix:
+    def __init__(self, indptr, indices, data, shape):
+        self.indptr = indptr        # (columns + 1,) start of each column in indices/data
+        self.indices = indices      # (nonzeros,) row of each value, ascending within a column
+        self.data = data            # (nonzeros,) the values
+        self.shape = shape
+
+    @classmethod
+    def from_coo(cls, rows, cols, values, shape, dtype=np.float64):
+        """builds the matrix from (row, column, value) triples; zeros are dropped."""
+        keep = values != 0
+        rows, cols, values = rows[keep], cols[keep], values[keep]
+        order = np.lexsort((rows, cols))
+        indptr = np.zeros(shape[1] + 1, dtype=np.intp)
+        np.cumsum(np.bincount(cols, minlength=shape[1]), out=indptr[1:])
+        return cls(indptr, rows[order].astype(np.intp), values[order].astype(dtype), shape)
+
+    @classmethod
+    def from_dense(cls, a):
+        rows, cols = np.nonzero(a)
+        return cls.from_coo(rows, cols, a[rows, cols], a.shape, a.dtype)
+
+    @property
+    def nbytes(self):
+        return self.indptr.nbytes + self.indices.nbytes + self.data.nbytes
+
+    def column(self, j):
+        """(rows, values) of the nonzeros in column j."""
+        start, stop = self.indptr[j], self.indptr[j + 1]
+        return self.indices[start:stop], self.data[start:stop]
+
+    def positions(self, cols):
+        """the positions in indices/data of the nonzeros of several columns,
+        one column after another, and how many each column has."""
+        starts = self.indptr[cols]
+        lengths = self.indptr[np.asarray(cols) + 1] - starts
+        ends = np.cumsum(lengths)
+        return np.arange(ends[-1] if len(ends) else 0) + np.repeat(starts - ends + lengths, lengths), lengths
+
+    def map(self, f):
+        """a matrix with the same nonzeros, with f applied to the values."""
+        return CSCMatrix(self.indptr, self.indices, f(self.data), self.shape)
+
+    def toarray(self, fill=0.0):
+        a = np.full(self.shape, fill, dtype=self.data.dtype)
+        a[self.indices, np.repeat(np.arange(self.shape[1]), np.diff(self.indptr))] = self.data
+        return a
+
+class SparseModel:
+    def __init__(self, states, vocab, pi, A, B):
+        self.key = next(_model_keys)
+        self.states = states        # index -> hidden state name
+        self.vocab = vocab          # Vocabulary, index <-> output name
+        self.state_index = {s: i for i, s in enumerate(states)}
+        self.pi = pi                # (S,) P(state | '#'), dense
+        self.A_csc = A              # CSCMatrix (S, S) P(next state | state)
+        self.B_csc = B              # CSCMatrix (S, V) P(output | state)
+        self.unknown = None         # UnknownWords for unseen outputs, if any
+        with np.errstate(divide='ignore'):
+            self.log_pi = np.log(pi)
+        self.log_A_csc = A.map(np.log)
+        self.log_B_csc = B.map(np.log)
+        self._A = None
+        self._log_A = None
+        self._dense = None
+
+    @classmethod
+    def load(cls, basename, dtype=np.float64):
+        """builds the sparse tables straight from basename.trans and basename.emit."""
+        states, vocab, p_start, (rows, cols, p), (emitters, outputs, q) = _read_model(basename)
+        pi = np.zeros(len(states), dtype=dtype)
+        pi[p_start[0]] = p_start[1]
+        A = CSCMatrix.from_coo(rows, cols, p, (len(states), len(states)), dtype)
+        B = CSCMatrix.from_coo(emitters, outputs, q, (len(states), len(vocab)), dtype)
+        return cls(states, vocab, pi, A, B)
+
+    @classmethod
+    def from_model(cls, model):
+        """the sparse form of a CompiledModel."""
+        return cls(model.states, model.vocab, np.array(model.pi),
+                   CSCMatrix.from_dense(np.asarray(model.A)), CSCMatrix.from_dense(np.asarray(model.B)))
+
+    @property
+    def nbytes(self):
+        # The log tables share their indptr and indices with the tables;
+        # count whatever dense tables have been built too
+        total = self.pi.nbytes * 2 + self.A_csc.nbytes + self.B_csc.nbytes + self.log_A_csc.data.nbytes + self.log_B_csc.data.nbytes
+        for a in (self._A, self._log_A):
+            if a is not None:
+                total += a.nbytes
+        if self._dense is not None:
+            total += self._dense.A.nbytes + self._dense.B.nbytes
+            if self._dense._logs is not None:
+                total += sum(a.nbytes for a in self._dense._logs)
+        return total
+
+    # The transitions are only S x S, so the algorithms that step through
+    # them (forward, the filters, beam and N-best decoding, generate) get a
+    # dense A; emissions always stay sparse. Only what has no sparse path at
+    # all (to_dicts, with_outputs for training) builds the dense model.
+    def densify(self):
+        """the equivalent CompiledModel, built once."""
+        if self._dense is None:
+            self._dense = CompiledModel(self.states, self.vocab, self.pi, self.A, self.B_csc.toarray())
+        return self._dense
+
+    @property
+    def A(self):
+        if self._A is None:
+            self._A = self.A_csc.toarray()
+        return self._A
+
+    @property
+    def log_A(self):
+        if self._log_A is None:
+            self._log_A = self.log_A_csc.toarray(fill=-np.inf)
+        return self._log_A
+
+    def to_dicts(self):
+        return self.densify().to_dicts()
+
+    def with_outputs(self, names):
+        return self.densify().with_outputs(names)
+
+    def emission_column(self, column):
+        if column >= len(self.vocab):
+            return self.unknown.F[column - len(self.vocab)]
+        emission = np.zeros(len(self.states), dtype=self.pi.dtype)
+        if column >= 0:
+            rows, values = self.B_csc.column(column)
+            emission[rows] = values
+        return emission
+
+    def log_emission_column(self, column):
+        """(states, log probabilities) for the states that can emit the
+        output at column, which must not be -1."""
+        if column >= len(self.vocab):
+            log_f = self.unknown.log_F[column - len(self.vocab)]
+            states = np.flatnonzero(np.isfinite(log_f))
+            return states, log_f[states]
+        return self.log_B_csc.column(column)
+
+    column = CompiledModel.column
+    encode = CompiledModel.encode
+
+    def log_emissions(self, sequence):
+        return self.log_emission_rows(self.encode(sequence))
+
+    def log_emission_rows(self, columns):
+        """like CompiledModel.log_emission_rows, filled in from the sparse columns."""
+        E = np.full(columns.shape + (len(self.states),), -np.inf)
+        flat = E.reshape(-1, len(self.states))
+        columns = columns.ravel()
+        cells = np.flatnonzero((columns >= 0) & (columns < len(self.vocab)))
+        positions, lengths = self.log_B_csc.positions(columns[cells])
+        flat[np.repeat(cells, lengths), self.log_B_csc.indices[positions]] = self.log_B_csc.data[positions]
+        if self.unknown is not None:
+            unseen = columns >= len(self.vocab)
+            flat[unseen] = self.unknown.log_F[columns[unseen] - len(self.vocab)]
+        return E
+
+def _sparse_viterbi(model, columns, profile=None):
+    """Viterbi over a SparseModel for one sequence of vocabulary indices.
+    Each step scores only the states that can emit the current output, each
+    against only its possible predecessors, so the work per token follows
+    the nonzeros rather than S^2. Returns (path, log_prob) like one row of
+    _viterbi_lattice, which it falls back on if no path survives."""
+    if profile is not None:
+        start = time.perf_counter()
+    log_A = model.log_A_csc
+    M = np.full(len(model.states), -np.inf)  # scores of the last step's live states
+    steps = []                               # (live states, their backpointers) per step
+    for t, column in enumerate(columns):
+        if column < 0:
+            break
+        emitters, emit = model.log_emission_column(column)
+        if t == 0:
+            scores = model.log_pi[emitters] + emit
+            backpointers = np.zeros(len(emitters), dtype=np.intp)
+        else:
+            positions, lengths = log_A.positions(emitters)
+            previous = log_A.indices[positions]
+            candidates = M[previous] + log_A.data[positions]
+            # Best predecessor of each emitter: sort each one's candidates
+            # best first, keeping the lowest state on ties like np.argmax
+            owner = np.repeat(np.arange(len(emitters)), lengths)
+            order = np.lexsort((-candidates, owner))
+            firsts = (np.cumsum(lengths) - lengths)[lengths > 0]
+            has_previous = lengths > 0
+            scores = np.full(len(emitters), -np.inf)
+            backpointers = np.zeros(len(emitters), dtype=np.intp)
+            scores[has_previous] = candidates[order[firsts]] + emit[has_previous]
+            backpointers[has_previous] = previous[order[firsts]]
+            M[steps[-1][0]] = -np.inf
+        live = np.isfinite(scores)
+        if not live.any():
+            break
+        steps.append((emitters[live], backpointers[live]))
+        M[emitters[live]] = scores[live]
+    else:
+        if len(steps):
+            if profile is not None:
+                profile.add('dp', time.perf_counter() - start)
+                profile.count('dp_steps', len(steps))
+                start = time.perf_counter()
+            states, _ = steps[-1]
+            state = states[int(np.argmax(M[states]))]
+            log_prob = M[state]
+            path = np.zeros(len(steps), dtype=np.intp)
+            for t in range(len(steps) - 1, -1, -1):
+                path[t] = state
+                states, backpointers = steps[t]
+                state = backpointers[np.searchsorted(states, state)]
+            if profile is not None:
+                profile.add('backtrace', time.perf_counter() - start)
+            return path, log_prob
+    # Some output can't be produced: decode it the dense way for the same answer
+    most_likely, log_probs = _viterbi_lattice(model, model.log_emission_rows(np.asarray(columns))[None], profile)
+    return most_likely[0], log_probs[0]
+
+def _viterbi_lattice(model, E, profile=None):
+    """runs Viterbi over a (batch, time, states) array of log emissions.
+    Returns the best path of state indices for each row, shape (batch, time),
+    and the log probability of each path. A Profile gets the time spent in
+    the DP loop and in the backtrace."""
+    if profile is not None:
+        start = time.perf_counter()
+    batch, num_observations, num_states = E.shape
+    Backpointers = np.zeros((num_observations, batch, num_states), dtype=np.intp)
+
+    # First observation comes from the start state '#'
+    M = model.log_pi + E[:, 0]
+
+    # Propagate forward: each step is one max/argmax over (prev state, state)
+    for i in range(1, num_observations):
+        scores = M[:, :, None] + model.log_A
+        Backpointers[i] = np.argmax(scores, axis=1)
+        M = np.take_along_axis(scores, Backpointers[i][:, None, :], axis=1)[:, 0] + E[:, i]
+    if profile is not None:
+        profile.add('dp', time.perf_counter() - start)
+        profile.count('dp_steps', num_observations)
+        start = time.perf_counter()
+
+    # Follow the backpointers from the most likely final state
+    rows = np.arange(batch)
+    most_likely = np.zeros((batch, num_observations), dtype=np.intp)
+    most_likely[:, -1] = np.argmax(M, axis=1)
+    for i in range(num_observations - 1, 0, -1):
+        most_likely[:, i - 1] = Backpointers[i, rows, most_likely[:, i]]
+    if profile is not None:
+        profile.add('backtrace', time.perf_counter() - start)
+    return most_likely, M[rows, most_likely[:, -1]]
+
+# Approximate and N-best decoding, one sequence at a time. Beam search trades
+# exactness for work per step; list Viterbi finds the k best paths.
+
+def _prune(M, beam=None, threshold=None):
+    """the states worth extending from scores M, in ascending order: the
+    beam best, and only those within threshold of the best. All of them if
+    none has a finite score, so the result matches plain Viterbi there."""
+    live = np.flatnonzero(np.isfinite(M))
+    if len(live) == 0:
+        return np.arange(len(M))
+    if threshold is not None:
+        live = live[M[live] >= M[live].max() - threshold]
+    if beam is not None and len(live) > beam:
+        live = np.sort(live[np.argsort(-M[live], kind='stable')[:beam]])
+    return live
+
+def _beam_viterbi(model, E, beam=None, threshold=None):
+    """Viterbi over a (time, states) array of log emissions that only
+    extends the states _prune keeps at each step, so a step costs
+    O(live * S) rather than O(S^2). Returns (path, log_prob); the path is
+    the best one that stays inside the beam, which need not be the best."""
+    num_observations, num_states = E.shape
+    columns = np.arange(num_states)
+    Backpointers = np.zeros((num_observations, num_states), dtype=np.intp)
+    M = model.log_pi + E[0]
+    for i in range(1, num_observations):
+        live = _prune(M, beam, threshold)
+        scores = M[live][:, None] + model.log_A[live]
+        best = np.argmax(scores, axis=0)
+        Backpointers[i] = live[best]
+        M = scores[best, columns] + E[i]
+    most_likely = np.zeros(num_observations, dtype=np.intp)
+    most_likely[-1] = np.argmax(M)
+    for i in range(num_observations - 1, 0, -1):
+        most_likely[i - 1] = Backpointers[i, most_likely[i]]
+    return most_likely, M[most_likely[-1]]
+
+def _nbest_viterbi(model, E, k):
+    """list Viterbi over a (time, states) array of log emissions: keeps the
+    k best partial paths into every state instead of one. Returns up to k
+    (path, log_prob) pairs, best first, leaving out impossible paths."""
+    num_observations, num_states = E.shape
+    # M[s, r] is the score of the r-th best path ending in s; -inf if none
+    M = np.full((num_states, k), -np.inf)
+    M[:, 0] = model.log_pi + E[0]
+    Backpointers = np.zeros((num_observations, num_states, k), dtype=np.intp)
+    for i in range(1, num_observations):
+        # Every (previous state, rank) extended into every state
+        scores = (M[:, :, None] + model.log_A[:, None, :]).reshape(num_states * k, num_states)
+        top = np.argsort(-scores, axis=0, kind='stable')[:k]
+        Backpointers[i] = top.T  # index of previous state * k + rank
+        M = np.take_along_axis(scores, top, axis=0).T + E[i][:, None]
+
+    paths = []
+    final = M.ravel()
+    for index in np.argsort(-final, kind='stable')[:k]:
+        if not np.isfinite(final[index]):
+            break
+        path = np.zeros(num_observations, dtype=np.intp)
+        state, rank = divmod(int(index), k)
+        for i in range(num_observations - 1, -1, -1):
+            path[i] = state
+            if i:
+                state, rank = divmod(int(Backpointers[i, state, rank]), k)
+        paths.append((path, final[index]))
+    return paths
+
+# Forward-backward over a batch of sequences of the same length. Each step
+# of both passes is one (batch, S) x (S, S) product; alpha is rescaled to
+# sum to one at every step and beta is divided by the same factors, so
+# alpha * beta is the posterior with no underflow.
+
+def _emission_rows(B, columns):
+    """E[n, t] = P(output at t | each state) for (batch, time) vocabulary
+    indices; zero for unknown outputs."""
+    E = np.zeros(columns.shape + (B.shape[0],))
+    known = columns >= 0
+    E[known] = B[:, columns[known]].T
+    return E
+
+def _forward_backward(pi, A, E):
+    """returns (log_likelihoods, alpha, beta, scale) for each row of a
+    (batch, time, states) array of emission probabilities. Rows no state
+    sequence can produce get -inf and all-zero alpha and beta."""
+    batch, num_observations, num_states = E.shape
+
+    alpha = np.zeros((batch, num_observations, num_states))
+    scale = np.ones((batch, num_observations))
+    a = pi * E[:, 0]
+    for t in range(num_observations):
+        if t:
+            a = (alpha[:, t - 1] @ A) * E[:, t]
+        total = a.sum(axis=1)
+        possible = total > 0
+        alpha[possible, t] = a[possible] / total[possible, None]
+        scale[possible, t] = total[possible]
+        scale[~possible, t] = 0.0
+
+    beta = np.zeros((batch, num_observations, num_states))
+    beta[:, -1] = 1.0
+    safe = np.where(scale > 0, scale, 1.0)
+    for t in range(num_observations - 2, -1, -1):
+        beta[:, t] = ((E[:, t + 1] * beta[:, t + 1]) @ A.T) / safe[:, t + 1, None]
+
+    with np.errstate(divide='ignore'):
+        log_likelihoods = np.log(scale).sum(axis=1)
+    impossible = ~np.isfinite(log_likelihoods)
+    alpha[impossible] = 0.0
+    beta[impossible] = 0.0
+    return log_likelihoods, alpha, beta, scale
+
+def _expected_counts(pi, A, B, batches):
+    """the E-step of Baum-Welch: expected start, transition and emission
+    counts summed over every sequence in batches, a list of (n, T) arrays of
+    vocabulary indices. Returns (start, trans, emit, log_likelihood, skipped)
+    where skipped counts the sequences the model can't produce at all."""
+    num_states, num_outputs = B.shape
+    start = np.zeros(num_states)
+    trans = np.zeros((num_states, num_states))
+    emit = np.zeros((num_states, num_outputs))
+    log_likelihood = 0.0
+    skipped = 0
+    for columns in batches:
+        E = _emission_rows(B, columns)
+        log_likelihoods, alpha, beta, scale = _forward_backward(pi, A, E)
+        possible = np.isfinite(log_likelihoods)
+        skipped += int((~possible).sum())
+        log_likelihood += log_likelihoods[possible].sum()
+        gamma = alpha * beta  # P(state at t | sequence)
+        start += gamma[:, 0].sum(axis=0)
+        if columns.shape[1] > 1:
+            # sum over t of P(state at t, next state at t+1 | sequence)
+            ahead = E[:, 1:] * beta[:, 1:] / np.where(scale[:, 1:] > 0, scale[:, 1:], 1.0)[:, :, None]
+            trans += A * np.einsum('nti,ntj->ij', alpha[:, :-1], ahead)
+        flat = np.maximum(columns.ravel(), 0)  # unknown outputs only occur in skipped rows
+        gamma = gamma.reshape(len(flat), num_states)
+        for s in range(num_states):
+            emit[s] += np.bincount(flat, weights=gamma[:, s], minlength=num_outputs)
+    return start, trans, emit, log_likelihood, skipped
+
+def _expected_counts_task(args):
+    return _expected_counts(*args)
+
+def _normalize(counts, fallback):
+    """the M-step: each row of counts scaled to sum to one. Rows with no
+    counts at all (nothing observed) keep their fallback probabilities."""
+    totals = counts.sum(axis=-1, keepdims=True)
+    return np.where(totals > 0, counts / np.where(totals > 0, totals, 1.0), fallback)
+
+# ForwardFilter - the forward algorithm run one observation at a time. Only
+# the current filtered distribution P(state | observations so far) is kept,
+# rescaled to sum to one at every step, plus the running log likelihood, so
+# each new observation costs O(S^2) no matter how long the sequence gets.
+
+class ForwardFilter:
+    def __init__(self, hmm):
+        self.model = hmm.model
+        self.reset()
+
+    def reset(self):
+        """forgets every observation pushed so far."""
+        self.belief = None          # P(state | observations so far); None before the first
+        self.log_likelihood = 0.0   # log P(observations so far)
+        self.steps = 0
+
+    def push(self, observation):
+        """folds one more observation into the belief and returns the new belief."""
+        model = self.model
+        prior = model.pi if self.belief is None else self.belief @ model.A
+        alpha = prior * model.emission_column(model.column(observation))
+        total = alpha.sum()
+        if total > 0:
+            self.belief = alpha / total
+            self.log_likelihood += np.log(total)
+        else:
+            # No state can produce this sequence
+            self.belief = alpha
+            self.log_likelihood = -np.inf
+        self.steps += 1
+        return self.belief
+
+    def most_likely(self):
+        """the most likely current state, or '#' if there is none yet."""
+        if self.belief is None or not self.belief.any():
+            return '#'
+        return self.model.states[int(np.argmax(self.belief))]
+
+# StreamingFilter - a ForwardFilter for live feeds. It consumes observations
+# from any iterator or async iterator and reports after every step. With
+# lag > 0 it also reports the fixed-lag smoothed belief about the state lag
+# steps back, from a window of the last lag observations, so its memory
+# stays O(lag * S) however long the stream runs.
+
+FilterStep = collections.namedtuple('FilterStep', [
+    'time',             # index of this observation in the stream
+    'observation',
+    'belief',           # P(state now | observations so far)
+    'state',            # most likely state now
+    'log_likelihood',   # log P(observations so far)
+    'smoothed',         # P(state at time - lag | observations so far), or None
+])
+
+class StreamingFilter(ForwardFilter):
+    def __init__(self, hmm, lag=0):
+        self.lag = lag
+        super().__init__(hmm)
+
+    def reset(self):
+        super().reset()
+        # The last lag + 1 beliefs and observation columns, oldest first
+        self._window = collections.deque(maxlen=self.lag + 1)
+
+    def step(self, observation):
+        """pushes one observation and returns a FilterStep for it."""
+        belief = self.push(observation)
+        self._window.append((belief, self.model.column(observation)))
+        smoothed = None
+        if self.lag and len(self._window) == self.lag + 1:
+            smoothed = self._smooth(0)
+        return FilterStep(self.steps - 1, observation, belief, self.most_likely(),
+                          self.log_likelihood, smoothed)
+
+    def _smooth(self, k):
+        """P(state at window position k | everything in the window so far):
+        the filtered belief there times a backward pass over the rest."""
+        model = self.model
+        beta = np.ones(len(model.states))
+        for _, column in reversed(list(itertools.islice(self._window, k + 1, None))):
+            beta = model.A @ (model.emission_column(column) * beta)
+            total = beta.sum()
+            if total > 0:
+                beta /= total  # only the shape matters; keep it from underflowing
+        smoothed = self._window[k][0] * beta
+        total = smoothed.sum()
+        return smoothed / total if total > 0 else smoothed
+
+    def flush(self):
+        """smoothed beliefs for the steps still inside the window, oldest
+        first, using every observation seen so far. Call at end of stream."""
+        start = 1 if len(self._window) == self.lag + 1 else 0
+        return [self._smooth(k) for k in range(start, len(self._window))]
+
+    def run(self, observations):
+        """yields a FilterStep for each observation of an iterable."""
+        for observation in observations:
+            yield self.step(observation)
+
+    async def arun(self, observations):
+        """yields a FilterStep for each observation of an async iterable."""
+        async for observation in observations:
+            yield self.step(observation)
+
+async def read_observations(reader):
+    """yields the whitespace separated observations arriving on an
+    asyncio.StreamReader (or any async iterable of lines)."""
+    async for line in reader:
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        for observation in line.split():
+            yield observation
+
+# Sampler - draws whole batches of sequences from a model at once. Every row
+# of pi, A and B is turned into a cumulative distribution once; the rows are
+# laid end to end, each shifted up by its row number, so one searchsorted
+# call finds the next state (or output) of every sequence in the batch. A
+# sparse model's emission rows lay out only their nonzeros.
+
+class _CumulativeTable:
+    def __init__(self, P):
+        P = np.asarray(P, dtype=np.float64)
+        totals = P.sum(axis=1, keepdims=True)
+        cumulative = np.cumsum(P / np.where(totals > 0, totals, 1.0), axis=1)
+        cumulative[:, -1] = 1.0  # no rounding gap at the top
+        self.width = P.shape[1]
+        self.flat = (cumulative + np.arange(len(P))[:, None]).ravel()
+        # Where u is so close to 1 that row + u rounds up to the next row
+        self.last = self.width - 1 - np.argmax(P[:, ::-1] > 0, axis=1)
+
+        self.columns = None
+
+    @classmethod
+    def from_csc(cls, M):
+        """the table for a CSCMatrix, laying out only its nonzeros."""
+        rows = M.indices
+        cols = np.repeat(np.arange(M.shape[1]), np.diff(M.indptr))
+        order = np.lexsort((cols, rows))
+        rows, cols, values = rows[order], cols[order], M.data[order].astype(np.float64)
+        counts = np.bincount(rows, minlength=M.shape[0])
+        totals = np.bincount(rows, values, minlength=M.shape[0])
+        cumulative = np.cumsum(values / np.where(totals > 0, totals, 1.0)[rows])
+        ends = np.cumsum(counts)
+        starts = ends - counts
+        # Restart the sum at each row
+        cumulative -= np.concatenate(([0.0], cumulative))[starts][rows]
+        cumulative[ends[counts > 0] - 1] = 1.0
+        table = cls.__new__(cls)
+        table.flat = cumulative + rows
+        table.columns = cols
+        table.last = np.maximum(ends - 1, 0)
+        return table
+
+    def sample(self, rows, u):
+        """for each row index, the column whose cumulative range holds u."""
+        positions = np.searchsorted(self.flat, rows + u, side='right')
+        if self.columns is not None:
+            return self.columns[np.minimum(positions, self.last[rows])]
+        return np.minimum(positions - rows * self.width, self.last[rows])
+
+class Sampler:
+    def __init__(self, model):
+        self.model = model
+        self.start = _CumulativeTable(np.asarray(model.pi)[None])
+        self.transitions = _CumulativeTable(model.A)
+        if isinstance(model, SparseModel):
+            self.emissions = _CumulativeTable.from_csc(model.B_csc)
+        else:
+            self.emissions = _CumulativeTable(model.B)
+
+    def draw(self, count, n, rng=np.random):
+        """samples count sequences of length n. Returns (states, outputs),
+        two (count, n) arrays of indices. rng is a numpy Generator, or the
+        np.random module itself (the default) to use its global state. The
+        uniforms are drawn in sequence order, so drawing in batches gives
+        the same sequences as drawing all at once."""
+        u = rng.random((count, n, 2))
+        states = np.zeros((count, n), dtype=np.intp)
+        outputs = np.zeros((count, n), dtype=np.intp)
+        zero = np.zeros(count, dtype=np.intp)
+        for t in range(n):
+            if t == 0:
+                states[:, t] = self.start.sample(zero, u[:, t, 0])
+            else:
+                states[:, t] = self.transitions.sample(states[:, t - 1], u[:, t, 0])
+            outputs[:, t] = self.emissions.sample(states[:, t], u[:, t, 1])
+        return states, outputs
+
+# LRUCache - a bounded least-recently-used cache that counts hits, misses
+# and evictions to help size it. As the DecodeCache it holds decoding
+# results, keyed on the model's key, the decoding options and the tuple of
+# tokens, so a repeated sentence costs one hash lookup; one cache can be
+# shared by several HMMs. (bn_inference's InferenceSession uses it too.)
+
+class LRUCache:
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __reduce__(self):
+        # Worker processes get an empty cache of the same size, not the entries
+        return (type(self), (self.maxsize,))
+
+    def get(self, key):
+        """the value stored under key, or None; marks it most recently used."""
+        value = self._entries.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        """stores value under key, evicting the least recently used entries
+        beyond maxsize."""
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def items(self):
+        """the (key, value) pairs, least recently used first; doesn't count
+        as a lookup."""
+        return list(self._entries.items())
+
+    def clear(self):
+        """drops every entry; the counters keep running."""
+        self._entries.clear()
+
+    def stats(self):
+        """the counters as a dict."""
+        lookups = self.hits + self.misses
+        return {'size': len(self._entries), 'maxsize': self.maxsize, 'hits': self.hits,
+                'misses': self.misses, 'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0}
+
+DecodeCache = LRUCache
+
+# Profile - opt-in instrumentation for an HMM. Phases (load, encode, the
+# Viterbi DP loop, backtrace, ...) accumulate call counts and wall time, and
+# counters track tokens, sentences, DP steps and the like. An HMM without a
+# profile skips all of it; the hot paths only test for None.
+
+class Profile:
+    def __init__(self):
+        self.phases = {}    # name -> [calls, seconds]
+        self.counters = {}  # name -> count
+
+    def add(self, name, seconds, calls=1):
+        """records calls to phase name that took seconds in all."""
+        phase = self.phases.setdefault(name, [0, 0.0])
+        phase[0] += calls
+        phase[1] += seconds
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """times the body of a with statement as one call to phase name."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def reset(self):
+        self.phases.clear()
+        self.counters.clear()
+
+    def as_dict(self):
+        """the timings and counters as plain data, ready for json.dumps."""
+        phases = {name: {'calls': calls, 'seconds': seconds, 'mean_ms': 1e3 * seconds / calls if calls else 0.0}
+                  for name, (calls, seconds) in self.phases.items()}
+        result = {'phases': phases, 'counters': dict(self.counters)}
+        steps = self.counters.get('dp_steps')
+        if steps and 'dp' in phases:
+            result['dp_us_per_step'] = 1e6 * phases['dp']['seconds'] / steps
+        return result
+
+_NO_PHASE = contextlib.nullcontext()
+
 # HMM model
 class HMM:
-    def __init__(self, transitions={}, emissions={}):
+    def __init__(self, transitions={}, emissions={}, dtype=np.float64, sparse=False, unknown_words=False,
+                 decode_cache_size=0, profile=False):
         """creates a model from transition and emission probabilities
         e.g. {'happy': {'silent': '0.2', 'meow': '0.3', 'purr': '0.5'},
               'grumpy': {'silent': '0.5', 'meow': '0.4', 'purr': '0.1'},
@@ -28,153 +1285,651 @@ class HMM:
 
 
 
+        self.basename = None  # set by load
+        self._cached = False  # True if self.model maps basename's binary cache
+        self._sampler = None  # built by generate
+        # Remembers decoded sentences; set to a shared DecodeCache, or None for none
+        self.decode_cache = DecodeCache(decode_cache_size) if decode_cache_size else None
+        # Instrumentation of the hot paths, or None (the default) for none
+        self.profile = Profile() if profile else None
         self.transitions = transitions
         self.emissions = emissions
+        self.dtype = dtype  # float64, or float32 to halve the size of the arrays
+        self.sparse = sparse  # keep the tables as a SparseModel instead of dense arrays
+        self.unknown_words = unknown_words  # give unseen outputs UnknownWords emissions
+        self.model = None
+        if transitions or emissions:
+            self.compile()
 
     ## part 1 - you do this.
-    def load(self, basename):
+    def load(self, basename, cache=True):
         """reads HMM structure from transition (basename.trans),
         and emission (basename.emit) files,
-        as well as the probabilities."""
-        # Load transitions
-        self.transitions = {}
-        with open(f"{basename}.trans", "r") as trans_file:
-            for line in trans_file:
-                parts = line.strip().split()
-                state = parts[0]
-                if state not in self.transitions:
-                    self.transitions[state] = {}
-                for i in range(1, len(parts), 2):
-                    next_state = parts[i]
-                    probability = parts[i + 1]
-                    self.transitions[state][next_state] = probability  # keep as string if needed
-
-        # Load emissions
-        self.emissions = {}
-        with open(f"{basename}.emit", "r") as emit_file:
-            for line in emit_file:
-                parts = line.strip().split()
-                state = parts[0]
-                if state not in self.emissions:
-                    self.emissions[state] = {}
-                for i in range(1, len(parts), 2):
-                    output = parts[i]
-                    probability = parts[i + 1]
-                    self.emissions[state][output] = probability  # keep as string if needed
+        as well as the probabilities.
+        With cache, the arrays come from (and go to) basename.hmmc;
+        a sparse model is always built from the text files."""
+        # Build the numeric model straight from the files; every algorithm
+        # below works from it. The dicts are only parsed if something reads them.
+        self.basename = basename
+        self._transitions = None
+        self._emissions = None
+        with self._phase('load'):
+            if self.sparse:
+                self.model = SparseModel.load(basename, self.dtype)
+                self._cached = False
+            elif cache:
+                self.model = CompiledModel.load_cached(basename, self.dtype)
+                self._cached = isinstance(self.model.B, np.memmap)
+            else:
+                self.model = CompiledModel.load(basename, self.dtype)
+                self._cached = False
+        self._add_unknown_words()
+
+    def save(self, basename):
+        """writes the model to basename.trans and basename.emit, in the
+        format load reads. Zero probabilities are left out."""
+        for ext, table in zip(("trans", "emit"), self.model.to_dicts()):
+            with open(f"{basename}.{ext}", "w") as f:
+                for state, row in table.items():
+                    for name, probability in row.items():
+                        f.write(f"{state} {name} {probability}\n")
+
+    @property
+    def transitions(self):
+        """transition probabilities as a dict of dicts of strings."""
+        if self._transitions is None:
+            if self.basename is None:
+                self._transitions = self.model.to_dicts()[0]  # trained, not loaded
+            else:
+                self._transitions = read_table(f"{self.basename}.trans")
+        return self._transitions
+
+    @transitions.setter
+    def transitions(self, transitions):
+        self._transitions = transitions
+
+    @property
+    def emissions(self):
+        """emission probabilities as a dict of dicts of strings."""
+        if self._emissions is None:
+            if self.basename is None:
+                self._emissions = self.model.to_dicts()[1]
+            else:
+                self._emissions = read_table(f"{self.basename}.emit")
+        return self._emissions
+
+    @emissions.setter
+    def emissions(self, emissions):
+        self._emissions = emissions
+
+    ## Compiled model: dense arrays built once from the dicts above.
+    def compile(self):
+        """(re)builds self.model from self.transitions and self.emissions.
+        Call this again after editing the dicts by hand."""
+        with self._phase('compile'):
+            self.model = CompiledModel.from_dicts(self.transitions, self.emissions, self.dtype)
+            if self.sparse:
+                self.model = SparseModel.from_model(self.model)
+        self._add_unknown_words()
+        return self.model
+
+    def _add_unknown_words(self):
+        if self.unknown_words:
+            with self._phase('unknown_words'):
+                self.model.unknown = UnknownWords.from_model(self.model)
+
+    ## Instrumentation
+    def _phase(self, name):
+        # A timer for the with statement, or a no-op without a profile
+        return _NO_PHASE if self.profile is None else self.profile.phase(name)
+
+    def _count_tokens(self, columns):
+        profile = self.profile
+        profile.count('sentences', len(columns) if columns.ndim > 1 else 1)
+        profile.count('tokens', columns.size)
+        profile.count('unknown_tokens', int(((columns < 0) | (columns >= len(self.model.vocab))).sum()))
+
+    def report(self):
+        """the profile (see Profile.as_dict) together with the state of the
+        caches, as a dict; None if profiling is off."""
+        if self.profile is None:
+            return None
+        report = self.profile.as_dict()
+        report['caches'] = {
+            'binary_cache_mapped': self._cached,
+            'decode_cache': self.decode_cache.stats() if self.decode_cache is not None else None,
+            'vocabulary_memo': len(self.model.vocab._memo) if self.model is not None else 0,
+        }
+        return report
 
     # Generate a random sequence
-    def generate(self, n):
-        """return an n-length Sequence by randomly sampling from this HMM."""
-        state = '#'
-        states = []
-        emissions = []
-        for i in range(n):
-            next_state = np.random.choice(list(self.transitions[state].keys()), p=[float(x) for x in self.transitions[state].values()])
-            states.append(next_state)
-            emission = np.random.choice(list(self.emissions[next_state].keys()), p=[float(x) for x in self.emissions[next_state].values()])
-            emissions.append(emission)
-            state = next_state
-        return Sequence(states, emissions)
+    def generate(self, n, seed=None):
+        """return an n-length Sequence by randomly sampling from this HMM.
+        With a seed the draw is reproducible; without one it comes from
+        np.random's global state."""
+        return next(self.generate_many(1, n, seed))
+
+    def sampler(self):
+        """the Sampler for the current model, built on first use."""
+        if self._sampler is None or self._sampler.model is not self.model:
+            self._sampler = Sampler(self.model)
+        return self._sampler
+
+    def generate_many(self, count, n, seed=None, batch_size=1024):
+        """yields count n-length Sequences, drawn batch_size at a time.
+        The same seed gives the same sequences, whatever the batch size."""
+        model = self.model
+        sampler = self.sampler()
+        rng = np.random if seed is None else np.random.default_rng(seed)
+        for start in range(0, count, batch_size):
+            with self._phase('generate'):
+                states, outputs = sampler.draw(min(batch_size, count - start), n, rng)
+            if self.profile is not None:
+                self.profile.count('generated_tokens', states.size)
+            for state_row, output_row in zip(states.tolist(), outputs.tolist()):
+                yield Sequence([model.states[s] for s in state_row], [model.vocab[o] for o in output_row])
+
+    def write_sequences(self, filename, count, n, seed=None, tagged=False, batch_size=1024):
+        """streams count generated n-length sequences to filename in the
+        .obs format read_sentences reads (one per line, blank lines between),
+        or with tagged in the .tagged.obs format (states line, then outputs)."""
+        with open(filename, "w") as f:
+            for sequence in self.generate_many(count, n, seed, batch_size):
+                if tagged:
+                    f.write(str(sequence))
+                else:
+                    f.write('\n' + ' '.join(sequence.outputseq) + '\n')
 
     ## The forward algorithm:
     def forward(self, sequence):
-        """return the most likely state sequence for the given sequence of observations."""
-        # Number of states and sequence length
-        states = list(self.transitions.keys())
-        num_states = len(states)
-        num_observations = len(sequence)
+        """return the most likely final state for the given sequence of observations."""
+        belief = ForwardFilter(self)
+        with self._phase('forward'):
+            for observation in sequence:
+                belief.push(observation)
+        if self.profile is not None:
+            self.profile.count('forward_tokens', len(sequence))
+        return belief.most_likely()
 
-        # Initialize matrix to store forward probabilities
-        M = np.zeros((num_states, num_observations))
+    def forward_filter(self, sequence):
+        """runs the forward algorithm, rescaling at each step so long
+        sequences don't underflow. Returns (log_likelihood, beliefs) where
+        log_likelihood is log P(sequence) and beliefs[t] is the filtered
+        distribution P(state at t | sequence[:t+1])."""
+        belief = ForwardFilter(self)
+        beliefs = np.zeros((len(sequence), len(self.model.states)))
+        with self._phase('forward'):
+            for t, observation in enumerate(sequence):
+                beliefs[t] = belief.push(observation)
+        if self.profile is not None:
+            self.profile.count('forward_tokens', len(sequence))
+        return belief.log_likelihood, beliefs
 
-        # Set start state probability to observation 1
-        M[0, 0] = 1.0
+    def forward_backward(self, sequence):
+        """smoothing: returns (log_likelihood, posteriors) where posteriors[t]
+        is P(state at t | the whole sequence). All zeros if no state sequence
+        can produce it."""
+        model = self.model
+        if len(sequence) == 0:
+            return 0.0, np.zeros((0, len(model.states)))
+        E = np.exp(model.log_emissions(sequence))[None]
+        log_likelihoods, alpha, beta, _ = _forward_backward(model.pi, model.A, E)
+        return float(log_likelihoods[0]), (alpha * beta)[0]
 
-        # Calculate probabilities for each state and observation
-        for s in states:
-            if s == '#': # Skip the start state
-                continue
-            # Check if the state is in the transitions and emissions
-            if s in self.transitions[states[0]] and sequence[1] in self.emissions[s]:
-                M[states.index(s), 1] = float(self.transitions[states[0]][s]) * float(self.emissions[s][sequence[1]])
+    ##  The Viterbi algorithm:
+    def viterbi(self, sequence, beam=None, threshold=None):
+        """return the most likely state sequence for hidden states.
+        With beam and/or threshold, only the beam best states, or those within
+        threshold (in log probability) of the best, are extended at each step:
+        faster on models with many states, but no longer guaranteed exact."""
+        return list(self.decode(sequence, beam, threshold))
+
+    def decode(self, sequence, beam=None, threshold=None):
+        """like viterbi, but returns a tuple. The sequence is only read, so
+        any sequence of observations will do. With a decode_cache, repeated
+        inputs are answered from the cache."""
+        cache = self.decode_cache
+        if cache is None:
+            return self._decode(sequence, beam, threshold)[0]
+        key = (self.model.key, beam, threshold, tuple(sequence))
+        found = cache.get(key)
+        if found is None:
+            found = self._decode(sequence, beam, threshold)
+            cache.put(key, found)
+        return found[0]
+
+    def _decode(self, sequence, beam, threshold):
+        # (states, log probability of that path) for one sequence
+        if len(sequence) == 0:
+            return (), 0.0
+        model = self.model
+        with self._phase('encode'):
+            columns = model.encode(sequence)
+        if self.profile is not None:
+            self._count_tokens(columns)
+        if beam is not None or threshold is not None:
+            with self._phase('beam'):
+                most_likely, log_prob = _beam_viterbi(model, model.log_emission_rows(columns), beam, threshold)
+        elif isinstance(model, SparseModel):
+            most_likely, log_prob = _sparse_viterbi(model, columns, self.profile)
+        else:
+            with self._phase('emissions'):
+                E = model.log_emission_rows(columns)[None]
+            most_likely, log_probs = _viterbi_lattice(model, E, self.profile)
+            most_likely, log_prob = most_likely[0], log_probs[0]
+        # Convert the indices to the actual states
+        return tuple(model.states[i] for i in most_likely), float(log_prob)
+
+    def nbest(self, sequence, k):
+        """the k most likely state sequences for hidden states, best first,
+        as (states, log_prob) pairs. Fewer if fewer paths are possible."""
+        if len(sequence) == 0:
+            return [([], 0.0)]
+        model = self.model
+        return [([model.states[i] for i in path], float(log_prob))
+                for path, log_prob in _nbest_viterbi(model, model.log_emissions(sequence), k)]
+
+    def viterbi_batch(self, sequences):
+        """decodes many sequences at once. Sequences of the same length are
+        stacked, so each time step of the dynamic program is one operation
+        over a (batch, states) array instead of one per sequence.
+        Returns (paths, log_probs): the most likely state sequence for each
+        input, and the log probability of that path. With a decode_cache,
+        only the sequences it hasn't seen are decoded."""
+        cache = self.decode_cache
+        if cache is None:
+            return self._viterbi_batch(sequences)
+        keys = [(self.model.key, None, None, tuple(sequence)) for sequence in sequences]
+        found = [cache.get(key) for key in keys]
+        # Decode each missing sequence once, however often it repeats
+        missing = list(dict.fromkeys(key for key, value in zip(keys, found) if value is None))
+        if missing:
+            paths, log_probs = self._viterbi_batch([key[-1] for key in missing])
+            decoded = {key: (tuple(path), float(log_prob)) for key, path, log_prob in zip(missing, paths, log_probs)}
+            for key, value in decoded.items():
+                cache.put(key, value)
+            found = [value or decoded[key] for key, value in zip(keys, found)]
+        return [list(states) for states, _ in found], np.array([log_prob for _, log_prob in found])
+
+    def _viterbi_batch(self, sequences):
+        model = self.model
+        paths = [[] for _ in sequences]
+        log_probs = np.zeros(len(sequences))
+        if isinstance(model, SparseModel):
+            # Sparse decoding goes one sequence at a time
+            for i, sequence in enumerate(sequences):
+                if len(sequence):
+                    paths[i], log_probs[i] = self._decode(sequence, None, None)
+                    paths[i] = list(paths[i])
+            return paths, log_probs
+        by_length = collections.defaultdict(list)
+        for i, sequence in enumerate(sequences):
+            if len(sequence):
+                by_length[len(sequence)].append(i)
+        for length, members in by_length.items():
+            with self._phase('encode'):
+                columns = model.encode([o for i in members for o in sequences[i]]).reshape(len(members), length)
+            if self.profile is not None:
+                self._count_tokens(columns)
+            with self._phase('emissions'):
+                E = model.log_emission_rows(columns)
+            most_likely, scores = _viterbi_lattice(model, E, self.profile)
+            log_probs[members] = scores
+            for i, row in zip(members, most_likely.tolist()):
+                paths[i] = [model.states[s] for s in row]
+        return paths, log_probs
+
+    ## Batch decoding: many independent sentences, optionally across processes.
+    def viterbi_many(self, sentences, processes=1, chunksize=256):
+        """yields viterbi(sentence) for each sentence, in input order.
+        With processes > 1 (None for one per core) chunks of sentences are
+        decoded by a pool of worker processes sharing this model."""
+        chunks = _chunked(sentences, chunksize)
+        if processes == 1:
+            for chunk in chunks:
+                yield from self.viterbi_batch(chunk)[0]
+            return
+
+        # Workers map the same binary cache if there is one; otherwise
+        # they get a copy of this model
+        source = self.basename if self._cached else self
+        processes = processes or os.cpu_count()
+        with multiprocessing.Pool(processes, initializer=_init_worker, initargs=(source, self.dtype, self.unknown_words)) as pool:
+            # Keep a bounded window of chunks in flight, so a huge corpus is
+            # never read (or held) all at once
+            pending = collections.deque()
+            for chunk in chunks:
+                pending.append(pool.apply_async(_viterbi_chunk, (chunk,)))
+                if len(pending) >= 4 * processes:
+                    yield from pending.popleft().get()
+            while pending:
+                yield from pending.popleft().get()
+
+    ## Baum-Welch: re-estimate the probabilities from unlabelled sequences.
+    def train(self, sequences, iterations=10, tolerance=1e-4, processes=1, batch_size=512):
+        """fits the model to sequences of observations with Baum-Welch (EM),
+        starting from the current probabilities. Each iteration runs
+        forward-backward over every sequence, stacked by length, and
+        re-estimates pi, A and B from the expected counts. With processes > 1
+        (None for one per core) the sequences are shared among worker
+        processes and their counts summed.
+        Stops after iterations, or once the log likelihood gains less than
+        tolerance per observation. Outputs the model has never seen are added
+        to its vocabulary; sequences it can't produce at all are left out.
+        Returns the log likelihood of the data at the start of each iteration."""
+        sequences = [list(sequence) for sequence in sequences if len(sequence)]
+        model = self.model.with_outputs(o for sequence in sequences for o in sequence)
+        by_length = collections.defaultdict(list)
+        for sequence in sequences:
+            by_length[len(sequence)].append(sequence)
+        batches = []
+        for length, group in by_length.items():
+            for chunk in _chunked(group, batch_size):
+                batches.append(model.encode([o for sequence in chunk for o in sequence]).reshape(len(chunk), length))
+        num_observations = sum(map(len, sequences))
+
+        processes = processes or os.cpu_count()
+        shards = [batches[i::processes] for i in range(processes)]
+        pi, A, B = (np.array(a, dtype=np.float64) for a in (model.pi, model.A, model.B))
+        history = []
+        with multiprocessing.Pool(processes) if processes > 1 else contextlib.nullcontext() as pool:
+            for _ in range(iterations):
+                with self._phase('train_e_step'):
+                    if pool is None:
+                        results = [_expected_counts(pi, A, B, batches)]
+                    else:
+                        results = pool.map(_expected_counts_task, [(pi, A, B, shard) for shard in shards])
+                    start, trans, emit, log_likelihood, _ = (sum(r[k] for r in results) for k in range(5))
+                history.append(float(log_likelihood))
+                with self._phase('train_m_step'):
+                    pi, A, B = _normalize(start, pi), _normalize(trans, A), _normalize(emit, B)
+                if len(history) > 1 and history[-1] - history[-2] < tolerance * num_observations:
+                    break
+
+        self.model = CompiledModel(model.states, model.vocab, pi.astype(self.dtype), A.astype(self.dtype), B.astype(self.dtype))
+        if self.sparse:
+            self.model = SparseModel.from_model(self.model)
+        self._add_unknown_words()
+        # The dicts now come from the trained arrays, not the files
+        self.basename = None
+        self._cached = False
+        self._transitions = None
+        self._emissions = None
+        return history
+
+def _chunked(items, size):
+    """yields lists of up to size items."""
+    items = iter(items)
+    while True:
+        chunk = list(itertools.islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+
+# Worker process state for HMM.viterbi_many.
+_worker_hmm = None
+
+def _init_worker(source, dtype, unknown_words=False):
+    """pool initializer: gets the model once per worker, either an HMM
+    or the basename of one to load (mapping the shared binary cache)."""
+    global _worker_hmm
+    if isinstance(source, HMM):
+        _worker_hmm = source
+    else:
+        _worker_hmm = HMM(dtype=dtype, unknown_words=unknown_words)
+        _worker_hmm.load(source)
+
+def _viterbi_chunk(sentences):
+    return _worker_hmm.viterbi_batch(sentences)[0]
+
+# Server mode. An HMMServer loads its models once and answers requests, one
+# JSON object per line, from any number of clients over a unix socket, TCP
+# on localhost, or stdin/stdout. The asyncio loop only reads, parses and
+# writes; the decoding itself runs in an executor: one worker thread, or a
+# pool of worker processes that each map the models' binary caches.
+#
+#   {"id": 1, "op": "decode", "tokens": ["i", "shot", "the", "elephant", "."]}
+#   {"id": 1, "states": ["PRON", "VERB", "DET", "NOUN", "."], "log_prob": -31.9}
+#
+# Requests may name a "model" (one the server was started with; the first
+# is the default). Ops:
+#   decode    tokens (or text, or sentences for a batch); beam, threshold, nbest
+#   forward   tokens or text -> log_likelihood and the most likely final state
+#   generate  n, count (default 1), seed -> sequences of states and outputs
+#   stats     request counts and the models served
+# Failures come back as {"id": ..., "error": "..."}.
+
+# Per-process models for HMMServer, all loaded when the worker starts
+_server_hmms = {}
+_server_options = {}
+_server_cache = True
+
+def _init_server(options, models=(), cache=True):
+    global _server_options, _server_cache
+    _server_options = options
+    _server_cache = cache
+    _server_hmms.clear()
+    for name in models:
+        _server_hmm(name)
+
+def _server_hmm(name):
+    hmm = _server_hmms.get(name)
+    if hmm is None:
+        hmm = HMM(**_server_options)
+        hmm.load(name, cache=_server_cache)
+        _server_hmms[name] = hmm
+    return hmm
+
+def _server_models():
+    return sorted(_server_hmms)
+
+def _request_tokens(request):
+    if 'tokens' in request:
+        return list(request['tokens'])
+    return request.get('text', '').split()
+
+def handle_request(request, model):
+    """answers one request (a dict) with the named model, loaded in this
+    process; returns the response without its id."""
+    hmm = _server_hmm(model)
+    op = request.get('op', 'decode')
+    if op == 'decode':
+        if 'sentences' in request:
+            paths, log_probs = hmm.viterbi_batch([list(s) for s in request['sentences']])
+            return {'paths': paths, 'log_probs': log_probs.tolist()}
+        tokens = _request_tokens(request)
+        if request.get('nbest'):
+            return {'paths': [{'states': states, 'log_prob': log_prob}
+                              for states, log_prob in hmm.nbest(tokens, int(request['nbest']))]}
+        beam, threshold = request.get('beam'), request.get('threshold')
+        if beam is None and threshold is None:
+            paths, log_probs = hmm.viterbi_batch([tokens])
+            return {'states': paths[0], 'log_prob': float(log_probs[0])}
+        return {'states': list(hmm.decode(tokens, beam, threshold))}
+    if op == 'forward':
+        log_likelihood, beliefs = hmm.forward_filter(_request_tokens(request))
+        state = hmm.model.states[int(np.argmax(beliefs[-1]))] if len(beliefs) and beliefs[-1].any() else '#'
+        return {'log_likelihood': float(log_likelihood), 'state': state}
+    if op == 'generate':
+        sequences = hmm.generate_many(int(request.get('count', 1)), int(request['n']), request.get('seed'))
+        return {'sequences': [{'states': s.stateseq, 'outputs': s.outputseq} for s in sequences]}
+    raise ValueError(f"unknown op {op!r}")
+
+class HMMServer:
+    def __init__(self, models, processes=1, cache=True, line_limit=2 ** 26, **options):
+        """serves the given model basenames; options go to each HMM (sparse,
+        unknown_words, decode_cache_size, ...). processes > 1 decodes in
+        that many worker processes (None for one per core). cache=False
+        parses the text files without reading or writing binary caches.
+        Request lines longer than line_limit bytes are answered with an
+        error."""
+        self.models = list(models)
+        self.processes = processes
+        self.cache = cache
+        self.line_limit = line_limit
+        self.options = options
+        self.requests = 0
+        self.errors = 0
+        self.executor = None
+
+    def start(self):
+        """starts the workers, each of which loads every model before its
+        first request (any missing binary caches are built here first, so
+        the workers only map them)."""
+        if self.cache and not self.options.get('sparse'):
+            for name in self.models:
+                HMM(**self.options).load(name)
+        initargs = (self.options, self.models, self.cache)
+        if self.processes == 1:
+            workers = 1
+            self.executor = concurrent.futures.ThreadPoolExecutor(1, initializer=_init_server, initargs=initargs)
+        else:
+            workers = self.processes or os.cpu_count()
+            self.executor = concurrent.futures.ProcessPoolExecutor(workers, initializer=_init_server, initargs=initargs)
+        # Start the workers now rather than on the first requests; a model
+        # that fails to load breaks the pool here
+        for future in [self.executor.submit(_server_models) for _ in range(workers)]:
+            future.result()
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    async def respond(self, line):
+        """the response line to one request line."""
+        self.requests += 1
+        request = {}
+        try:
+            request = json.loads(line)
+            if request.get('op') == 'stats':
+                response = {'requests': self.requests, 'errors': self.errors,
+                            'models': self.models, 'processes': self.processes}
             else:
-                M[states.index(s), 1] = 0.0 # Set to 0 if not in transitions or emissions
-
-        # Propagate forward
-        for i in range(2, num_observations):
-            for s in states:
-                if s == '#': # Skip the start state
-                    continue
-                sum_prob = 0
-                for s2 in states:
-                    t = self.transitions[s2][s] if s in self.transitions[s2] else 0.0
-                    e = self.emissions[s][sequence[i]] if sequence[i] in self.emissions[s] else 0.0
-                    sum_prob += M[states.index(s2), i - 1] * float(t) * float(e)
-                M[states.index(s), i] = sum_prob
-
-        # Return the state with the highest possible value in the last column
-        high_prob = np.argmax(M[:, num_observations - 1])
-        return states[high_prob]
+                model = request.get('model', self.models[0])
+                if model not in self.models:
+                    raise ValueError(f"model {model!r} is not served")
+                loop = asyncio.get_running_loop()
+                response = await loop.run_in_executor(self.executor, handle_request, request, model)
+        except Exception as e:
+            self.errors += 1
+            response = {'error': f"{type(e).__name__}: {e}"}
+        if isinstance(request, dict) and 'id' in request:
+            response = {'id': request['id'], **response}
+        return (json.dumps(response) + '\n').encode('utf-8')
 
-    ##  The Viterbi algorithm:
-    def viterbi(self, sequence):
-        """return the most likely state sequence for hidden states."""
-        sequence.insert(0, '-') # Add a dummy state to the beginning of the sequence (fix for off-by-one error)
-        # Number of states and sequence length
-        states = list(self.transitions.keys())
-        num_states = len(states)
-        num_observations = len(sequence)
-
-        # Initialize matrix to store forward probabilities
-        M = np.zeros((num_states, num_observations))
-        Backpointers = np.zeros((num_states, num_observations))
-
-        # Set start state probability to observation 1
-        M[0, 0] = 1.0
-
-        # Calculate probabilities for each state and observation
-        for s in states:
-            if s == '#':
+    async def handle_client(self, reader, writer):
+        """answers each line from reader on writer, concurrently, so a slow
+        request doesn't hold up the ones behind it; responses carry the
+        request's id to match them up."""
+        async def answer(line):
+            writer.write(await self.respond(line))
+            await writer.drain()
+
+        pending = set()
+        while True:
+            try:
+                line = await reader.readuntil(b'\n')
+            except asyncio.IncompleteReadError as e:
+                line = e.partial  # the last line may have no newline
+                if not line:
+                    break
+            except asyncio.LimitOverrunError:
+                await _skip_line(reader)
+                self.requests += 1
+                self.errors += 1
+                error = {'error': f"ValueError: request line longer than {self.line_limit} bytes"}
+                writer.write((json.dumps(error) + '\n').encode('utf-8'))
+                await writer.drain()
                 continue
-            if s in self.transitions[states[0]] and sequence[1] in self.emissions[s]:
-                M[states.index(s), 1] = float(self.transitions[states[0]][s]) * float(self.emissions[s][sequence[1]])
-            else:
-                M[states.index(s), 1] = 0.0
+            if line.strip():
+                task = asyncio.ensure_future(answer(line))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+        if pending:
+            await asyncio.wait(pending)
+        writer.close()
 
-        # Propagate forward
-        for i in range(2, num_observations):
-            for s in states:
-                if s == '#':
-                    continue
-                max_prob = 0 # Initialize the maximum probability
-                max_state = 0 # Initialize the state with the highest probability
-                for s2 in states:
-                    if s2 == '#':
-                        continue
-                    t = self.transitions[s2][s] if s in self.transitions[s2] else 0.0
-                    e = self.emissions[s][sequence[i]] if sequence[i] in self.emissions[s] else 0.0
-                    prob = M[states.index(s2), i - 1] * float(t) * float(e)
-                    # Check if the probability is higher than the current maximum
-                    if prob > max_prob:
-                        max_prob = prob
-                        max_state = states.index(s2) # Save the index of the state with the highest probability
-                M[states.index(s), i] = max_prob
-                Backpointers[states.index(s), i] = max_state
-
-        most_likely = []
-        # Find the most likely state
-        most_likely.append(np.argmax(M[:, num_observations - 1]))
-        # Find the most likely state for the rest of the observations
-        for i in range(num_observations - 1, 1, -1):
-            most_likely.append(int(Backpointers[most_likely[-1], i]))
-
-        # Reverse the list to get the most likely state in the right order
-        most_likely.reverse()
-        for i in range(len(most_likely)):
-            # Convert the index to the actual state
-            most_likely[i] = states[most_likely[i]]
-
-        return most_likely
+    async def serve(self, address):
+        """serves until cancelled: address is '-' for stdin/stdout,
+        host:port for TCP, or else the path of a unix socket."""
+        if address == '-':
+            loop = asyncio.get_running_loop()
+            reader = asyncio.StreamReader(limit=self.line_limit)
+            if stat.S_ISREG(os.fstat(sys.stdin.fileno()).st_mode):
+                # A pipe transport can't watch a regular file, as with
+                # --serve - < requests.jsonl: read it in a thread instead
+                async def feed():
+                    try:
+                        while True:
+                            block = await loop.run_in_executor(None, sys.stdin.buffer.read1, 1 << 16)
+                            if not block:
+                                break
+                            reader.feed_data(block)
+                    finally:
+                        reader.feed_eof()
+                feeding = asyncio.ensure_future(feed())
+                await self.handle_client(reader, _StdoutWriter())
+                await feeding
+                return
+            await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+            await self.handle_client(reader, _StdoutWriter())
+            return
+        if ':' in address:
+            host, port = address.rsplit(':', 1)
+            server = await asyncio.start_server(self.handle_client, host or 'localhost', int(port), limit=self.line_limit)
+        else:
+            _remove_stale_socket(address)
+            server = await asyncio.start_unix_server(self.handle_client, address, limit=self.line_limit)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            if ':' not in address and os.path.exists(address):
+                os.unlink(address)
+
+async def _skip_line(reader):
+    # Drops the rest of a line that overran the reader's limit, which is
+    # left in its buffer, up to and including the newline
+    while True:
+        try:
+            await reader.readuntil(b'\n')
+            return
+        except asyncio.LimitOverrunError as e:
+            await reader.readexactly(e.consumed)
+        except asyncio.IncompleteReadError:
+            return
+
+def _remove_stale_socket(path):
+    # A socket left behind by a server that was killed refuses connections;
+    # one that still answers belongs to a running server. Anything else at
+    # the path is left for bind to report.
+    try:
+        if not stat.S_ISSOCK(os.stat(path).st_mode):
+            return
+    except FileNotFoundError:
+        return
+    probe = socket.socket(socket.AF_UNIX)
+    try:
+        probe.connect(path)
+    except ConnectionRefusedError:
+        os.unlink(path)
+        return
+    finally:
+        probe.close()
+    raise OSError(errno.EADDRINUSE, f"a server is already listening on {path}")
+
+class _StdoutWriter:
+    # Just enough of asyncio.StreamWriter for handle_client
+    def write(self, data):
+        sys.stdout.buffer.write(data)
+        sys.stdout.buffer.flush()
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        pass
 
 if __name__ == '__main__':
     # Parse command line arguments
@@ -182,16 +1937,64 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="HMM")
     parser.add_argument("model", help="Basename of the transition/emission files (e.g., 'cat' for 'cat.trans' and 'cat.emit')")
     parser.add_argument("--generate", type=int, help="Generate a random sequence of given length")
+    parser.add_argument("--count", type=int, help="With --generate, write this many sequences to a .obs file")
+    parser.add_argument("--seed", type=int, help="Random seed for --generate")
+    parser.add_argument("--tagged", action="store_true", help="With --count, write the hidden states too (.tagged.obs format)")
+    parser.add_argument("--output", type=str, help="File for --generate --count (default MODEL_sequences.obs)")
     parser.add_argument("--forward", type=str, help="Compute the forward probability of a given sequence")
     parser.add_argument("--viterbi", type=str, help="Compute the most likely sequence of hidden states for a given sequence of observations")
+    parser.add_argument("--beam", type=int, help="Beam width for --viterbi: extend only this many states per step")
+    parser.add_argument("--threshold", type=float, help="Log probability beam for --viterbi: drop states this far below the best")
+    parser.add_argument("--nbest", type=int, help="Print the N most likely state sequences for --viterbi, with their log probabilities")
+    parser.add_argument("--stream", action="store_true", help="Filter observations read from stdin as they arrive")
+    parser.add_argument("--lag", type=int, default=0, help="Also print fixed-lag smoothed states this many steps back with --stream")
+    parser.add_argument("--batch", type=str, help="Tag each blank-line separated sentence of a file independently")
+    parser.add_argument("--workers", type=int, default=1, help="Worker processes for --batch and --train (0 for one per core)")
+    parser.add_argument("--train", type=str, help="Re-estimate the model with Baum-Welch on the blank-line separated sentences of a file")
+    parser.add_argument("--iterations", type=int, default=10, help="Most Baum-Welch iterations for --train")
+    parser.add_argument("--save", type=str, help="Write the (trained) model to SAVE.trans and SAVE.emit")
+    parser.add_argument("--sparse", action="store_true", help="Keep the probability tables sparse; decoding then only visits states that can emit each word")
+    parser.add_argument("--unknown-words", action="store_true", help="Tag words missing from the model by their suffix and shape instead of giving up")
+    parser.add_argument("--decode-cache", type=int, default=0, help="Remember this many decoded sentences for --batch (one worker) and report cache statistics on stderr")
+    parser.add_argument("--profile", nargs="?", const="-", help="Report timings, token counts and cache statistics as JSON, to stderr or to the given file")
+    parser.add_argument("--serve", type=str, help="Serve JSON line requests: '-' for stdin/stdout, HOST:PORT for TCP, or a unix socket path")
+    parser.add_argument("--models", nargs="*", default=[], help="More model basenames for --serve to load (the first argument is the default)")
+    parser.add_argument("--no-cache", action="store_true", help="Parse the text model files without reading or writing the binary cache")
 
     args = parser.parse_args()
-    hmm = HMM()
-    hmm.load(args.model)
+
+    # Keep the models loaded and answer requests until interrupted
+    if args.serve:
+        server = HMMServer([args.model] + args.models, processes=args.workers or None, cache=not args.no_cache,
+                           sparse=args.sparse, unknown_words=args.unknown_words, decode_cache_size=args.decode_cache)
+        server.start()
+        try:
+            asyncio.run(server.serve(args.serve))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
+        sys.exit(0)
+
+    hmm = HMM(sparse=args.sparse, unknown_words=args.unknown_words, decode_cache_size=args.decode_cache,
+              profile=args.profile is not None)
+    hmm.load(args.model, cache=not args.no_cache)
+
+    # Fit the model to unlabelled sentences before using it
+    if args.train:
+        history = hmm.train(read_sentences(args.train), iterations=args.iterations, processes=args.workers or None)
+        for i, log_likelihood in enumerate(history):
+            print(f"Iteration {i}: log likelihood {log_likelihood:.4f}")
+    if args.save:
+        hmm.save(args.save)
 
     # Generate a random sequence
-    if args.generate:
-        sequence = hmm.generate(args.generate)
+    if args.generate and args.count:
+        # A whole corpus, streamed straight to the file
+        file_name = args.output or f"{args.model}_sequences.obs"
+        hmm.write_sequences(file_name, args.count, args.generate, seed=args.seed, tagged=args.tagged)
+    elif args.generate:
+        sequence = hmm.generate(args.generate, seed=args.seed)
         print("Generated sequence:\n",sequence)
 
         # e.g. cat_sequence.obs, lander_sequence.obs, etc.
@@ -205,7 +2008,11 @@ if __name__ == '__main__':
     if args.forward:
         with open(args.forward, 'r') as obs_file:
             observations = obs_file.read().strip().split()
-            most_likely = hmm.forward(observations)
+            # Update the belief one sensor reading at a time
+            belief = ForwardFilter(hmm)
+            for reading in observations:
+                belief.push(reading)
+            most_likely = belief.most_likely()
             if args.model == 'lander':
                 # Safe places to land for the rover
                 if most_likely in ['2,5', '3,4', '4,3', '4,4', '5,5']:
@@ -217,8 +2024,36 @@ if __name__ == '__main__':
     if args.viterbi:
         with open(args.viterbi, 'r') as obs_file:
             observations = obs_file.read().strip().split()
-            most_likely = hmm.viterbi(observations)
-            print("Most likely hidden states:", most_likely)
+            if args.nbest:
+                for states, log_prob in hmm.nbest(observations, args.nbest):
+                    print(f"{log_prob:.4f}", states)
+            else:
+                most_likely = hmm.viterbi(observations, beam=args.beam, threshold=args.threshold)
+                print("Most likely hidden states:", most_likely)
+
+    # Report the belief after every observation arriving on stdin
+    if args.stream:
+        stream = StreamingFilter(hmm, lag=args.lag)
+        for step in stream.run(observation for line in sys.stdin for observation in line.split()):
+            line = f"{step.time} {step.observation} {step.state} {step.belief.max():.4f}"
+            if step.smoothed is not None:
+                line += f" {step.time - args.lag} {hmm.model.states[int(np.argmax(step.smoothed))]}"
+            print(line, flush=True)
+
+    # Tag a whole corpus, one sentence at a time, in the .tagged.obs format
+    if args.batch:
+        sentences, to_decode = itertools.tee(read_sentences(args.batch))
+        for sentence, tags in zip(sentences, hmm.viterbi_many(to_decode, processes=args.workers or None)):
+            print(' '.join(tags))
+            print(' '.join(sentence))
+        if hmm.decode_cache is not None:
+            print("Decode cache:", json.dumps(hmm.decode_cache.stats()), file=sys.stderr)
+
+    if args.profile == "-":
+        print(json.dumps(hmm.report(), indent=1), file=sys.stderr)
+    elif args.profile:
+        with open(args.profile, "w") as f:
+            json.dump(hmm.report(), f, indent=1)
 
     # else:
     #     print("HMM loaded with transitions and emissions:")
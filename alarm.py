@@ -1,6 +1,6 @@
 from pgmpy.models import BayesianNetwork
-from pgmpy.inference import VariableElimination
 from pgmpy.factors.discrete import TabularCPD
+from bn_inference import CompiledNetwork
 
 def create_alarm_model():
     alarm_model = BayesianNetwork(
@@ -52,7 +52,7 @@ def create_alarm_model():
 
 if __name__ == "__main__":
     alarm_model = create_alarm_model()
-    alarm_infer = VariableElimination(alarm_model)
+    alarm_infer = CompiledNetwork(alarm_model)
 
     # Original query: Probability of John calling given an earthquake
     print("Probability of JohnCalls given Earthquake:")
@@ -0,0 +1,188 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+from HMM import *
+
+# Benchmarks for HMM.py: load, generate, forward and viterbi on the shipped
+# models and on synthetic ones scaled in states and vocabulary. Each case
+# reports throughput (tokens/sec), per-call latency percentiles and the peak
+# memory traced while it runs. Results are saved as JSON, and a run can be
+# compared against an earlier one to flag regressions.
+#
+#   python benchmark_HMM.py --output bench.json
+#   python benchmark_HMM.py --baseline bench.json --threshold 0.2
+
+MODELS = ['cat', 'lander', 'partofspeech']
+# (states, vocabulary size, outputs per state)
+SYNTHETIC = [(50, 1000, 100), (200, 20000, 500)]
+
+# Metrics checked against a baseline; tail latencies are reported but too
+# noisy to gate on. tokens_per_sec is better bigger, the others smaller.
+GATED = ('tokens_per_sec', 'p50_ms', 'peak_bytes')
+HIGHER_IS_BETTER = ('tokens_per_sec',)
+
+def synthetic_model(num_states, vocab_size, outputs_per_state, seed=0):
+    """an HMM with random dense transitions, each state emitting a random
+    subset of the vocabulary."""
+    rng = np.random.default_rng(seed)
+    pi = rng.dirichlet(np.ones(num_states))
+    A = rng.dirichlet(np.full(num_states, 0.5), num_states)
+    B = np.zeros((num_states, vocab_size))
+    for s in range(num_states):
+        outputs = rng.choice(vocab_size, min(outputs_per_state, vocab_size), replace=False)
+        B[s, outputs] = rng.dirichlet(np.ones(len(outputs)))
+    hmm = HMM()
+    hmm.model = CompiledModel([f"s{i}" for i in range(num_states)],
+                              Vocabulary.from_names([f"w{i}" for i in range(vocab_size)]), pi, A, B)
+    return hmm
+
+def percentiles(latencies):
+    latencies = np.asarray(latencies) * 1e3
+    return {f"p{q}_ms": float(np.percentile(latencies, q)) for q in (50, 90, 99)}
+
+def peak_memory(f):
+    """the peak memory traced while f runs, in bytes."""
+    tracemalloc.start()
+    try:
+        f()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def measure(f, tokens, repeat):
+    """times f repeat times; tokens is how many tokens one call handles."""
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f()
+        latencies.append(time.perf_counter() - start)
+    result = {'tokens_per_sec': tokens / float(np.median(latencies)) if tokens else None}
+    result.update(percentiles(latencies))
+    result['peak_bytes'] = peak_memory(f)
+    return result
+
+def measure_each(f, items, repeat):
+    """times f on each item (one sentence, say), repeat passes over items."""
+    latencies = []
+    for _ in range(repeat):
+        for item in items:
+            start = time.perf_counter()
+            f(item)
+            latencies.append(time.perf_counter() - start)
+    tokens = sum(len(item) for item in items) * repeat
+    result = {'tokens_per_sec': tokens / sum(latencies)}
+    result.update(percentiles(latencies))
+    result['peak_bytes'] = peak_memory(lambda: [f(item) for item in items])
+    return result
+
+def bench_model(name, basename, sentences, repeat, length):
+    """every case for one model saved as basename.trans/.emit."""
+    results = {}
+    tokens = sum(len(sentence) for sentence in sentences)
+
+    def load(cache):
+        hmm = HMM()
+        hmm.load(basename, cache=cache)
+        return hmm
+
+    results[f"{name}/load"] = measure(lambda: load(False), 0, repeat)
+    load(True)  # build the binary cache first
+    results[f"{name}/load_cached"] = measure(lambda: load(True), 0, repeat)
+
+    hmm = load(True)
+    results[f"{name}/generate"] = measure(lambda: list(hmm.generate_many(len(sentences), length, seed=0)), tokens, repeat)
+    results[f"{name}/forward"] = measure_each(hmm.forward_filter, sentences, repeat)
+    results[f"{name}/viterbi"] = measure_each(hmm.viterbi, sentences, repeat)
+    results[f"{name}/viterbi_batch"] = measure(lambda: hmm.viterbi_batch(sentences), tokens, repeat)
+    return results
+
+def run(models, synthetic, count, length, repeat):
+    results = {}
+    directory = tempfile.mkdtemp()
+    try:
+        for name in models:
+            # Work on a copy so the cache and timings don't touch the repo
+            for ext in ('trans', 'emit'):
+                shutil.copy(f"{name}.{ext}", os.path.join(directory, f"{name}.{ext}"))
+            hmm = HMM()
+            hmm.load(name, cache=False)
+            sentences = [s.outputseq for s in hmm.generate_many(count, length, seed=1)]
+            results.update(bench_model(name, os.path.join(directory, name), sentences, repeat, length))
+            print(f"{name}: done", file=sys.stderr)
+        for num_states, vocab_size, outputs_per_state in synthetic:
+            name = f"synthetic-{num_states}x{vocab_size}"
+            hmm = synthetic_model(num_states, vocab_size, outputs_per_state)
+            hmm.save(os.path.join(directory, name))
+            sentences = [s.outputseq for s in hmm.generate_many(count, length, seed=1)]
+            results.update(bench_model(name, os.path.join(directory, name), sentences, repeat, length))
+            print(f"{name}: done", file=sys.stderr)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return results
+
+def compare(results, baseline, threshold):
+    """the regressions of results against baseline: (case, metric, baseline
+    value, new value) wherever a GATED metric got worse by more than
+    threshold (a fraction, 0.2 for 20%)."""
+    regressions = []
+    for case, metrics in results.items():
+        for metric in GATED:
+            value = metrics.get(metric)
+            old = baseline.get(case, {}).get(metric)
+            if not old or value is None:
+                continue
+            if metric in HIGHER_IS_BETTER:
+                worse = value < old * (1 - threshold)
+            else:
+                worse = value > old * (1 + threshold)
+            if worse:
+                regressions.append((case, metric, old, value))
+    return regressions
+
+def report(results):
+    print(f"{'case':40} {'tokens/sec':>12} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'peak MB':>8}")
+    for case, m in results.items():
+        rate = f"{m['tokens_per_sec']:12.0f}" if m['tokens_per_sec'] else f"{'-':>12}"
+        print(f"{case:40} {rate} {m['p50_ms']:9.3f} {m['p90_ms']:9.3f} {m['p99_ms']:9.3f} {m['peak_bytes'] / 1e6:8.2f}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="HMM benchmarks")
+    parser.add_argument("--models", nargs="*", default=MODELS, help="Model basenames to benchmark")
+    parser.add_argument("--no-synthetic", action="store_true", help="Skip the synthetic models")
+    parser.add_argument("--count", type=int, default=200, help="Sentences per case")
+    parser.add_argument("--length", type=int, default=20, help="Tokens per sentence")
+    parser.add_argument("--repeat", type=int, default=5, help="Timed repetitions per case")
+    parser.add_argument("--quick", action="store_true", help="Small counts, for a smoke test")
+    parser.add_argument("--output", type=str, help="Save the results to this JSON file")
+    parser.add_argument("--baseline", type=str, help="Compare against the results in this JSON file")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Relative change that counts as a regression")
+    args = parser.parse_args()
+    if args.quick:
+        args.count, args.repeat = 20, 2
+
+    results = run(args.models, [] if args.no_synthetic else SYNTHETIC, args.count, args.length, args.repeat)
+    report(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({'meta': {'python': platform.python_version(), 'numpy': np.__version__,
+                                'platform': platform.platform(), 'cpus': os.cpu_count(),
+                                'count': args.count, 'length': args.length, 'repeat': args.repeat,
+                                'time': time.strftime('%Y-%m-%dT%H:%M:%S')},
+                       'results': results}, f, indent=1)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.threshold)
+        for case, metric, old, new in regressions:
+            print(f"REGRESSION {case} {metric}: {old:.4g} -> {new:.4g}")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions beyond {args.threshold:.0%}")
@@ -0,0 +1,495 @@
+import multiprocessing
+import os
+import statistics
+import numpy as np
+import pandas as pd
+import networkx as nx
+from pgmpy.factors.discrete import DiscreteFactor
+from HMM import LRUCache
+
+# Compiled exact inference for pgmpy BayesianNetworks. pgmpy's
+# VariableElimination works out an elimination order and multiplies factors
+# anew on every query; a CompiledNetwork turns the CPDs into numpy tensors
+# once, and for a small network (alarm.py, carnet.py) multiplies them out to
+# the full joint, so a query is a slice of the joint and a sum.
+#
+#   net = CompiledNetwork(create_car_model())
+#   net.query(["Battery"], evidence={"Moves": "no"})      # a DiscreteFactor
+#   net.posterior(["Battery"], evidence={"Moves": "no"})  # just the array
+#   net.posterior_batch(["Battery"], records[["Moves", "Radio"]])  # a row per record
+#
+# Networks whose joint would be too big are answered instead by one
+# np.einsum contraction over the CPDs of the query's ancestors, with the
+# contraction order worked out once per query shape. Networks too big even
+# for that can be sampled: sample_posterior() does likelihood weighting,
+# drawing whole batches of samples as arrays, with confidence intervals.
+#
+# An InferenceSession is for interactive use, with evidence coming and going
+# one item at a time: it memoizes answers and, without a joint, keeps the
+# network's factors reduced by the evidence so far, updating them by slicing
+# as evidence is added.
+
+class CompiledNetwork:
+    def __init__(self, model, max_joint=2 ** 20):
+        """compiles model, a BayesianNetwork with all its CPDs. The joint
+        is kept if it has at most max_joint entries."""
+        model.check_model()
+        # Topological order, so every variable comes after its parents
+        self.variables = list(nx.topological_sort(model))
+        self.index = {v: i for i, v in enumerate(self.variables)}
+        self.state_names = {}
+        self.parents = {}
+        cpds = {}
+        for v in self.variables:
+            cpd = model.get_cpds(v)
+            cpds[v] = cpd
+            self.state_names[v] = list(cpd.state_names[v])
+            self.parents[v] = list(cpd.variables[1:])
+        self.cards = [len(self.state_names[v]) for v in self.variables]
+        self.states = {v: {s: i for i, s in enumerate(names)} for v, names in self.state_names.items()}
+
+        ## One (table, axes) factor per CPD, with every axis in the state order of
+        ## the variable's own CPD (a child's CPD may list its parents' states differently)
+        self.factors = []
+        for v in self.variables:
+            cpd = cpds[v]
+            table = cpd.values
+            for axis, name in enumerate(cpd.variables):
+                order = [cpd.state_names[name].index(s) for s in self.state_names[name]]
+                table = np.take(table, order, axis=axis)
+            self.factors.append((np.ascontiguousarray(table, dtype=float), [self.index[n] for n in cpd.variables]))
+
+        self.joint = None
+        if np.prod(self.cards, dtype=float) <= max_joint:
+            self.joint = self._contract(self.factors, [], list(range(len(self.variables))))
+        # Per query shape (variables, evidence variables): how to answer it
+        self._plans = {}
+
+    def _contract(self, factors, extra, output, optimize='greedy'):
+        """np.einsum of the factors, and the (array, axes) pairs in extra,
+        keeping the output axes."""
+        args = []
+        for table, axes in list(factors) + list(extra):
+            args += [table, axes]
+        return np.einsum(*args, output, optimize=optimize)
+
+    def state_index(self, variable, state):
+        """the index of one of variable's states, given by name."""
+        try:
+            return self.states[variable][state]
+        except KeyError:
+            if variable not in self.states:
+                raise ValueError(f"unknown variable {variable!r}")
+            raise ValueError(f"unknown state {state!r} of {variable}")
+
+    def ancestors(self, variables):
+        """the indices of variables and all their ancestors, in topological order."""
+        keep = set()
+        stack = list(variables)
+        while stack:
+            v = stack.pop()
+            if v not in keep:
+                keep.add(v)
+                stack.extend(self.parents[v])
+        return sorted(self.index[v] for v in keep)
+
+    def _plan(self, variables, evidence):
+        key = (variables, evidence)
+        plan = self._plans.get(key)
+        if plan is not None:
+            return plan
+        self._check(variables, evidence)
+        query = [self.index[v] for v in variables]
+        observed = [self.index[v] for v in evidence]
+        if self.joint is not None:
+            # joint[indexer] drops the evidence axes; sum out all but the query
+            # ones, then put those in the order asked for
+            remaining = [i for i in range(len(self.variables)) if i not in observed]
+            summed = tuple(k for k, i in enumerate(remaining) if i not in query)
+            kept = [i for i in remaining if i in query]
+            plan = ('joint', summed, tuple(kept.index(i) for i in query))
+        else:
+            # Variables that aren't ancestors of the query or the evidence
+            # sum to one and drop out. Each piece of evidence is a one-hot
+            # vector on its variable's axis.
+            relevant = self.ancestors(list(variables) + list(evidence))
+            factors = [self.factors[i] for i in relevant]
+            indicators = [(np.ones(self.cards[i]), [i]) for i in observed]
+            if factors:
+                path = np.einsum_path(*sum(([t, a] for t, a in factors + indicators), []), query, optimize='greedy')[0]
+            else:
+                path = None  # nothing asked, nothing given: the probability is 1
+            plan = ('einsum', factors, path)
+        self._plans[key] = plan
+        return plan
+
+    def _check(self, variables, evidence):
+        for v in variables + evidence:
+            if v not in self.index:
+                raise ValueError(f"unknown variable {v!r}")
+        if set(variables) & set(evidence):
+            raise ValueError("a variable can't be both queried and given as evidence")
+        if len(set(variables)) < len(variables):
+            raise ValueError("variables repeats a variable")
+
+    def _evidence(self, evidence):
+        if not evidence:
+            return (), ()
+        names = tuple(evidence)
+        return names, tuple(self.state_index(v, evidence[v]) for v in names)
+
+    def unnormalized(self, variables, evidence=None):
+        """P(variables, evidence) as an array with an axis per variable, in
+        the order given; evidence maps variables to state names."""
+        variables = tuple(variables)
+        names, values = self._evidence(evidence)
+        plan = self._plan(variables, names)
+        if plan[0] == 'joint':
+            _, summed, order = plan
+            indexer = [slice(None)] * len(self.variables)
+            for v, value in zip(names, values):
+                indexer[self.index[v]] = value
+            result = self.joint[tuple(indexer)].sum(axis=summed)
+            return result.transpose(order)
+        _, factors, path = plan
+        if not factors:
+            return np.ones(())
+        indicators = []
+        for v, value in zip(names, values):
+            onehot = np.zeros(self.cards[self.index[v]])
+            onehot[value] = 1.0
+            indicators.append((onehot, [self.index[v]]))
+        return self._contract(factors, indicators, [self.index[v] for v in variables], optimize=path)
+
+    def posterior(self, variables, evidence=None):
+        """P(variables | evidence) as an array with an axis per variable, in
+        the order given."""
+        p = self.unnormalized(variables, evidence)
+        total = p.sum()
+        if total <= 0:
+            raise ValueError("the evidence has probability zero")
+        return p / total
+
+    def probability(self, evidence):
+        """P(evidence), for evidence mapping variables to state names."""
+        return float(self.unnormalized((), evidence))
+
+    def query(self, variables, evidence=None):
+        """P(variables | evidence) as a DiscreteFactor, like
+        VariableElimination.query (with joint=True)."""
+        variables = list(variables)
+        p = self.posterior(variables, evidence)
+        return DiscreteFactor(variables, [self.cards[self.index[v]] for v in variables], p,
+                              state_names={v: self.state_names[v] for v in variables})
+
+    def _codes(self, variable, column):
+        """column's state indices for variable, with -1 where it's missing."""
+        if variable not in self.index:
+            raise ValueError(f"unknown variable {variable!r}")
+        card = self.cards[self.index[variable]]
+        if isinstance(getattr(column, 'dtype', None), pd.api.extensions.ExtensionDtype):
+            # Nullable Int64 and the like: indices with pd.NA for missing
+            if pd.api.types.is_integer_dtype(column.dtype):
+                column = np.asarray(pd.Series(column).astype('float64'))
+        column = np.asarray(column)
+        if column.dtype.kind == 'f':
+            # Integer indices with NaN for missing, as pandas stores a column of
+            # ints with gaps
+            missing = np.isnan(column)
+            if not np.array_equal(column[~missing], np.round(column[~missing])):
+                raise ValueError(f"state indices of {variable} must be whole numbers")
+            column = np.where(missing, -1, column).astype(np.intp)
+        if column.dtype.kind in 'iu':
+            codes = column.astype(np.intp)
+            if ((codes < -1) | (codes >= card)).any():
+                raise ValueError(f"state index out of range for {variable}")
+            return codes
+        codes = pd.Index(self.state_names[variable]).get_indexer(column).astype(np.intp)
+        unknown = (codes < 0) & pd.notna(column)
+        if unknown.any():
+            raise ValueError(f"unknown state {column[unknown][0]!r} of {variable}")
+        return codes
+
+    def posterior_batch(self, variables, evidence, processes=1, chunksize=65536):
+        """P(variables | evidence) for every row of evidence: a DataFrame, a
+        structured array or a mapping of variable names to columns, holding
+        state names or state indices. A missing entry (None, NaN or -1)
+        leaves that variable unobserved in its row.
+        Returns a matrix with a row per evidence row and a column per joint
+        state of variables (C order, as in posterior(...).ravel()); rows
+        whose evidence is impossible are NaN. With processes > 1 (None for
+        one per core) chunks of rows are answered by a pool of worker
+        processes."""
+        variables = tuple(variables)
+        if isinstance(evidence, pd.DataFrame):
+            names = list(evidence.columns)
+        elif isinstance(evidence, np.ndarray):
+            names = list(evidence.dtype.names)
+        else:
+            names = list(evidence)
+        if set(variables) & set(names):
+            raise ValueError("a variable can't be both queried and given as evidence")
+        codes = np.column_stack([self._codes(name, evidence[name]) for name in names]) if names else None
+        if processes == 1 or codes is None or len(codes) <= chunksize:
+            return self._posterior_rows(variables, names, codes)
+
+        chunks = [codes[i:i + chunksize] for i in range(0, len(codes), chunksize)]
+        with multiprocessing.Pool(processes or os.cpu_count(), initializer=_init_worker, initargs=(self,)) as pool:
+            return np.concatenate(pool.map(_posterior_chunk, [(variables, names, chunk) for chunk in chunks]))
+
+    def _posterior_rows(self, variables, names, codes):
+        width = int(np.prod([self.cards[self.index[v]] for v in variables]))
+        if codes is None:
+            return self.posterior(variables).reshape(1, width)
+        result = np.empty((len(codes), width))
+        # Rows are grouped by which variables they observe; each group is
+        # answered by indexing the table P(those variables, variables)
+        observed = codes >= 0
+        patterns, groups = np.unique(observed, axis=0, return_inverse=True)
+        groups = groups.reshape(-1)
+        for g, pattern in enumerate(patterns):
+            rows = np.flatnonzero(groups == g)
+            given = [k for k, seen in enumerate(pattern) if seen]
+            table = self.unnormalized(tuple(names[k] for k in given) + variables)
+            p = table[tuple(codes[rows, k] for k in given)].reshape(-1, width)
+            total = p.sum(axis=1, keepdims=True)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                result[rows] = np.where(total > 0, p / total, np.nan)
+        return result
+
+    ## Approximate inference by likelihood weighting
+    def _sample(self, size, rng, relevant, observed):
+        """forward samples size assignments of the relevant variables (indices,
+        in topological order), with the observed ones (index -> state)
+        clamped. Returns an array of state indices per variable (rows of the
+        others are left unset) and each sample's weight, the probability of
+        the evidence given its parents."""
+        values = np.empty((len(self.variables), size), dtype=np.intp)
+        weights = np.ones(size)
+        for i in relevant:
+            table, axes = self.factors[i]
+            parents = tuple(values[a] for a in axes[1:])
+            if i in observed:
+                values[i] = observed[i]
+                weights *= table[(observed[i],) + parents]
+                continue
+            # One column of cumulative probabilities per sample (or just
+            # the one, without parents)
+            cumulative = np.cumsum(table[(slice(None),) + parents], axis=0)
+            u = rng.random(size)
+            if parents:
+                drawn = (u >= cumulative).sum(axis=0)
+            else:
+                drawn = np.searchsorted(cumulative, u, side='right')
+            values[i] = np.minimum(drawn, self.cards[i] - 1)
+        return values, weights
+
+    def _weighted_counts(self, variables, evidence, size, seed):
+        """draws size samples from the stream seed (a SeedSequence) and
+        returns their sums: of the weights and squared weights, in total and
+        by joint state of variables."""
+        query = [self.index[v] for v in variables]
+        observed = {self.index[v]: value for v, value in zip(*self._evidence(evidence))}
+        relevant = self.ancestors(list(variables) + list(evidence))
+        values, weights = self._sample(size, np.random.default_rng(seed), relevant, observed)
+        cards = [self.cards[i] for i in query]
+        states = np.ravel_multi_index(values[query], cards) if query else np.zeros(size, dtype=np.intp)
+        width = int(np.prod(cards))
+        return np.array([np.bincount(states, weights, width), np.bincount(states, weights ** 2, width)])
+
+    def sample_posterior(self, variables, evidence=None, samples=10 ** 6, batch_size=10 ** 5,
+                         seed=None, tolerance=None, confidence=0.95, processes=1):
+        """estimates P(variables | evidence) by likelihood weighting (plain
+        forward sampling, without evidence), in batches of batch_size
+        samples, up to samples in all. With a tolerance it stops early, once
+        every probability's confidence interval is within tolerance of it.
+        Batch k draws from the k-th stream spawned from seed, so (short of
+        stopping early) a seed gives the same estimate whether or not
+        processes > 1 (None for one per core) spreads the batches over a
+        pool of worker processes.
+        Returns a SampledPosterior."""
+        variables = tuple(variables)
+        evidence = dict(evidence or {})
+        # Check the query here rather than in every worker
+        self._check(variables, tuple(evidence))
+        self._evidence(evidence)
+        cards = [self.cards[self.index[v]] for v in variables]
+        z = statistics.NormalDist().inv_cdf(0.5 + confidence / 2)
+        streams = np.random.SeedSequence(seed)
+        processes = 1 if processes == 1 else processes or os.cpu_count()
+        pool = None
+        if processes > 1:
+            pool = multiprocessing.Pool(processes, initializer=_init_worker, initargs=(self,))
+        try:
+            sums, drawn = 0, 0
+            # A round is a batch per process
+            while drawn < samples:
+                tasks = []
+                for child in streams.spawn(processes):
+                    size = min(batch_size, samples - drawn)
+                    if size > 0:
+                        tasks.append((variables, evidence, size, child))
+                        drawn += size
+                if pool is not None:
+                    results = pool.map(_weighted_counts_task, tasks)
+                else:
+                    results = [self._weighted_counts(*task) for task in tasks]
+                for counts in results:
+                    sums = sums + counts
+                if tolerance is not None and sums[0].sum() > 0:
+                    if SampledPosterior(variables, cards, sums, drawn, z).error() <= tolerance:
+                        break
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        return SampledPosterior(variables, cards, sums, drawn, z)
+
+class SampledPosterior:
+    def __init__(self, variables, cards, sums, samples, z):
+        """a likelihood weighting estimate from sums: the weights, and the
+        squared weights, by joint state of variables."""
+        weights, squares = sums
+        total = weights.sum()
+        if total <= 0:
+            raise ValueError("no sample is consistent with the evidence")
+        self.variables = list(variables)
+        self.samples = samples
+        p = weights / total
+        self.posterior = p.reshape(cards)
+        # Delta-method variance of the self-normalized estimate, and Kish's
+        # effective sample size
+        variance = (squares * (1 - 2 * p) + p ** 2 * squares.sum()) / total ** 2
+        self.stderr = np.sqrt(np.maximum(variance, 0)).reshape(cards)
+        self.low = np.clip(self.posterior - z * self.stderr, 0, 1)
+        self.high = np.clip(self.posterior + z * self.stderr, 0, 1)
+        self.effective_samples = total ** 2 / squares.sum()
+        self._z = z
+
+    def error(self):
+        """the largest confidence interval half-width."""
+        return float(self._z * self.stderr.max())
+
+    def __repr__(self):
+        return f"SampledPosterior({self.variables}, samples={self.samples}, error={self.error():.3g})"
+
+class InferenceSession:
+    def __init__(self, net, maxsize=1024, reductions=16):
+        """queries on net (a CompiledNetwork, or a BayesianNetwork to compile)
+        under evidence that changes an item at a time. Answers are memoized
+        by (variables, evidence), up to maxsize of them. Without a joint, the
+        factors reduced by each recent evidence set are kept too, up to
+        reductions of them; with one, slicing the joint is already cheaper
+        than keeping track of reductions."""
+        self.net = net if isinstance(net, CompiledNetwork) else CompiledNetwork(net)
+        self.evidence = {}
+        self.answers = LRUCache(maxsize)
+        self.reduced = LRUCache(reductions) if self.net.joint is None else None
+        # Contraction paths, by (variables, evidence variables)
+        self._paths = {}
+
+    def observe(self, variable, state):
+        """adds (or changes) one piece of evidence."""
+        self.net.state_index(variable, state)
+        self.evidence[variable] = state
+        return self
+
+    def forget(self, variable):
+        """drops the evidence on variable, if there is any."""
+        self.evidence.pop(variable, None)
+        return self
+
+    def clear(self):
+        """drops all the evidence; memoized answers are kept."""
+        self.evidence = {}
+        return self
+
+    def _key(self):
+        return frozenset(self.evidence.items())
+
+    def _reduce(self, key):
+        """the factors reduced by the evidence key (a frozenset of items),
+        sliced from the factors of the largest reduced subset of it in the
+        cache (adding an item to the evidence slices just once)."""
+        factors = self.reduced.get(key)
+        if factors is not None:
+            return factors
+        # A factor per CPD; the evidence slices its variable's axis out of
+        # every factor that has it
+        start, factors = frozenset(), self.net.factors
+        for cached, reduced in self.reduced.items():
+            if len(cached) > len(start) and cached <= key:
+                start, factors = cached, reduced
+        for variable, state in key - start:
+            axis = self.net.index[variable]
+            value = self.net.state_index(variable, state)
+            factors = [(np.take(table, value, axis=axes.index(axis)), [a for a in axes if a != axis])
+                       if axis in axes else (table, axes) for table, axes in factors]
+        self.reduced.put(key, factors)
+        return factors
+
+    def _unnormalized(self, variables, key):
+        net = self.net
+        if net.joint is not None:
+            return net.unnormalized(variables, dict(key))
+        query = [net.index[v] for v in variables]
+        observed = [net.index[v] for v, _ in key]
+        factors = self._reduce(key)
+        # Only the factors of the query's and evidence's ancestors matter
+        factors = [factors[i] for i in net.ancestors(list(variables) + [v for v, _ in key])]
+        if not factors:
+            return np.ones(())
+        shape = (tuple(variables), frozenset(observed))
+        path = self._paths.get(shape)
+        if path is None:
+            args = sum(([t, a] for t, a in factors), [])
+            path = self._paths[shape] = np.einsum_path(*args, query, optimize='greedy')[0]
+        return net._contract(factors, [], query, optimize=path)
+
+    def posterior(self, variables):
+        """P(variables | the evidence) as an array with an axis per variable,
+        in the order given. Don't modify it: it's memoized."""
+        variables = tuple(variables)
+        self.net._check(variables, tuple(self.evidence))
+        key = (variables, self._key())
+        p = self.answers.get(key)
+        if p is None:
+            p = self._unnormalized(variables, key[1])
+            total = p.sum()
+            if total <= 0:
+                raise ValueError("the evidence has probability zero")
+            p = p / total
+            p.flags.writeable = False
+            self.answers.put(key, p)
+        return p
+
+    def probability(self):
+        """P(the evidence)."""
+        return float(self._unnormalized((), self._key()))
+
+    def query(self, variables):
+        """P(variables | the evidence) as a DiscreteFactor."""
+        variables = list(variables)
+        net = self.net
+        return DiscreteFactor(variables, [net.cards[net.index[v]] for v in variables], self.posterior(variables),
+                              state_names={v: net.state_names[v] for v in variables})
+
+    def stats(self):
+        stats = {'answers': self.answers.stats()}
+        if self.reduced is not None:
+            stats['reduced'] = self.reduced.stats()
+        return stats
+
+# Worker process state for CompiledNetwork.posterior_batch and sample_posterior.
+_worker_net = None
+
+def _init_worker(net):
+    global _worker_net
+    _worker_net = net
+
+def _posterior_chunk(args):
+    variables, names, codes = args
+    return _worker_net._posterior_rows(variables, names, codes)
+
+def _weighted_counts_task(args):
+    return _worker_net._weighted_counts(*args)
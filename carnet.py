@@ -1,6 +1,6 @@
 from pgmpy.models import BayesianNetwork
-from pgmpy.inference import VariableElimination
 from pgmpy.factors.discrete import TabularCPD
+from bn_inference import CompiledNetwork
 
 def create_car_model():
     car_model = BayesianNetwork(
@@ -75,7 +75,7 @@ def create_car_model():
 
 if __name__ == "__main__":
     car_model = create_car_model()
-    car_infer = VariableElimination(car_model)
+    car_infer = CompiledNetwork(car_model)
 
     # Original Query: Probability of the car moving given that the radio turns on and the car starts
     print("\nProbability of the car moving given that the radio turns on and the car starts:")
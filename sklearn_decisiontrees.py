@@ -1,13 +1,27 @@
 
 # from sklearn.datasets import load_iris
+import os
 from sklearn.datasets import load_breast_cancer
 from sklearn import tree
-from sklearn.model_selection import KFold
 from sklearn.ensemble import RandomForestClassifier, HistGradientBoostingClassifier
 import pandas as pd
-from sklearn.model_selection import GridSearchCV, KFold
+from sklearn.experimental import enable_halving_search_cv  # noqa: F401 (enables HalvingGridSearchCV)
+from sklearn.model_selection import HalvingGridSearchCV, KFold, cross_validate
 import joblib
 
+## Fitted fold models and CV results are cached on disk by joblib.Memory,
+## keyed on a hash of the arguments: the estimator and its parameters, the
+## data and the splitter. Rerunning an unchanged experiment just loads them.
+## Delete the directory (or point SKLEARN_CACHE elsewhere) to start over.
+memory = joblib.Memory(os.environ.get("SKLEARN_CACHE", ".sklearn_cache"), verbose=0)
+
+## Parallelism happens at one level only: folds and grid points run on
+## N_CORES worker processes, and every model inside them on one core
+## (n_jobs=1; joblib also caps HistGradientBoosting's OpenMP threads in
+## its workers). Forests with n_jobs=N_CORES inside N_CORES workers
+## would oversubscribe the cores N_CORES times over.
+N_CORES = joblib.cpu_count(only_physical_cores=True)
+print(f"Number of physical cores: {N_CORES}")
 
 ### This code shows how to use KFold to do cross_validation.
 ### This is just one of many ways to manage training and test sets in sklearn.
@@ -16,15 +30,14 @@ import joblib
 # X, y = iris.data, iris.target
 bc_data = load_breast_cancer()
 X, y = bc_data.data, bc_data.target
-scores = []
 kf = KFold(n_splits=5)
-for train_index, test_index in kf.split(X) :
-    X_train, X_test, y_train, y_test = \
-        (X[train_index], X[test_index], y[train_index], y[test_index])
-    # clf = tree.DecisionTreeClassifier()
-    clf = RandomForestClassifier(n_estimators=50, criterion='entropy')
-    clf.fit(X_train, y_train)
-    scores.append(clf.score(X_test, y_test))
+# clf = tree.DecisionTreeClassifier()
+clf = RandomForestClassifier(n_estimators=50, criterion='entropy', n_jobs=1)
+# The folds are fitted in parallel; the fitted models come back too (and are cached)
+cv_fold_results = memory.cache(cross_validate, ignore=["n_jobs"])(
+    clf, X, y, cv=kf, n_jobs=N_CORES, return_estimator=True
+)
+scores = list(cv_fold_results["test_score"])
 
 print(scores)
 average = sum(scores) / len(scores)
@@ -32,16 +45,16 @@ print(f"Average score: {average}")
 
 ## Part 2. This code (from https://scikit-learn.org/1.5/auto_examples/ensemble/plot_forest_hist_grad_boosting_comparison.html)
 ## shows how to use GridSearchCV to do a hyperparameter search to compare two techniques.
+## Here it uses HalvingGridSearchCV, the successive halving version: every
+## grid point is first scored on a small share of the samples, and only the
+## best half go on to the next round, with twice as many.
 # from sklearn.datasets import load_breast_cancer
 
 X,y = load_breast_cancer(return_X_y=True, as_frame=True)
 
-N_CORES = joblib.cpu_count(only_physical_cores=True)
-print(f"Number of physical cores: {N_CORES}")
-
 models = {
     "Random Forest": RandomForestClassifier(
-        min_samples_leaf=5, random_state=0, n_jobs=N_CORES
+        min_samples_leaf=5, random_state=0, n_jobs=1
     ),
     "Hist Gradient Boosting": HistGradientBoostingClassifier(
         max_leaf_nodes=15, random_state=0, early_stopping=False
@@ -53,15 +66,30 @@ param_grids = {
 }
 cv = KFold(n_splits=5, shuffle=True, random_state=0)
 
-results = []
-for name, model in models.items():
-    grid_search = GridSearchCV(
-        estimator=model,
-        param_grid=param_grids[name],
+@memory.cache(ignore=["n_jobs"])
+def search(estimator, param_grid, X, y, cv, n_jobs):
+    """the fitted successive halving search; (grid point, fold) fits run in
+    parallel on n_jobs processes."""
+    return HalvingGridSearchCV(
+        estimator=estimator,
+        param_grid=param_grid,
+        factor=2,
         return_train_score=True,
         cv=cv,
+        random_state=0,
+        n_jobs=n_jobs,
     ).fit(X, y)
-    result = {"model": name, "cv_results": pd.DataFrame(grid_search.cv_results_)}
+
+results = []
+for name, model in models.items():
+    grid_search = search(model, param_grids[name], X, y, cv, N_CORES)
+    # One row per grid point, from the last round it made it to, in
+    # parameter order. Grid points dropped early were scored on fewer
+    # samples (n_resources), so the plot below shows that too.
+    param = "param_" + list(param_grids[name])[0]
+    cv_results = pd.DataFrame(grid_search.cv_results_).sort_values("iter")
+    cv_results = cv_results.drop_duplicates(subset=param, keep="last").sort_values(param)
+    result = {"model": name, "cv_results": cv_results}
     results.append(result)
 
 print(results)
@@ -96,7 +124,8 @@ for idx, result in enumerate(results):
         y="mean_test_score",
         error_x="std_fit_time",
         error_y="std_test_score",
-        hover_data=param_name,
+        hover_data=[param_name, "n_resources"],
+        size="n_resources",
         color="model",
     )
     line_fig = px.line(
@@ -118,7 +147,8 @@ for idx, result in enumerate(results):
         y="mean_test_score",
         error_x="std_score_time",
         error_y="std_test_score",
-        hover_data=param_name,
+        hover_data=[param_name, "n_resources"],
+        size="n_resources",
     )
     line_fig = px.line(
         cv_results,
@@ -138,6 +168,7 @@ fig.update_layout(
     yaxis=dict(title="Test R2 score - higher is better"),
     xaxis2=dict(title="Predict time (s) - lower is better"),
     legend=dict(x=0.72, y=0.05, traceorder="normal", borderwidth=1),
-    title=dict(x=0.5, text="Speed-score trade-off of tree-based ensembles"),
+    title=dict(x=0.5, text="Speed-score trade-off of tree-based ensembles<br>"
+                           "<sup>marker size: samples each grid point was last scored on</sup>"),
 )
 fig.show()
\ No newline at end of file
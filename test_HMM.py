@@ -1,5 +1,14 @@
+import asyncio
+import io
+import itertools
+import os
+import shutil
+import socket
+import sys
+import tempfile
 from unittest import TestCase
 from HMM import *
+from HMM import _remove_stale_socket, _server_models
 
 class Test(TestCase):
     # Unit test for Load
@@ -12,4 +21,444 @@ class Test(TestCase):
                                            'hungry': {'happy': '0.1', 'grumpy': '0.6', 'hungry': '0.3'}}, h.transitions)
         self.assertEqual({'happy': {'silent': '0.2', 'meow': '0.3', 'purr': '0.5'},
                                          'grumpy': {'silent': '0.5', 'meow': '0.4', 'purr': '0.1'},
-                                         'hungry': {'silent': '0.2', 'meow': '0.6', 'purr': '0.2'}}, h.emissions)
\ No newline at end of file
+                                         'hungry': {'silent': '0.2', 'meow': '0.6', 'purr': '0.2'}}, h.emissions)
+    # Viterbi should tag each ambiguous sentence like the hand-tagged file
+    def test_viterbi(self):
+        h = HMM()
+        h.load("partofspeech")
+        with open("ambiguous_sents.obs") as f:
+            sentences = [s.split() for s in f.read().strip().split("\n\n")]
+        with open("ambiguous_sents.tagged.obs") as f:
+            tagged = [line.split() for line in f.read().strip().split("\n")[0::2]]
+        for sentence, tags in zip(sentences, tagged):
+            self.assertEqual(tags, h.viterbi(sentence))
+
+    # Long sequences must not underflow to zero and collapse to the first state
+    def test_viterbi_long_sequence(self):
+        h = HMM()
+        h.load("lander")
+        observations = ['1,1', '2,2', '3,3', '4,4'] + ['5,5'] * 2000
+        self.assertEqual(['1,1', '2,2', '3,3', '4,4'] + ['5,5'] * 2000, h.viterbi(observations))
+
+    # The compiled arrays should line up with the dicts they were built from
+    def test_compile(self):
+        h = HMM()
+        h.load("cat")
+        model = h.model
+        self.assertEqual(['happy', 'grumpy', 'hungry'], model.states)
+        self.assertEqual(["silent", "meow", "purr"], list(model.vocab))
+        np.testing.assert_allclose([0.5, 0.5, 0.0], model.pi)
+        self.assertAlmostEqual(0.4, model.A[model.state_index['happy'], model.state_index['hungry']])
+        self.assertAlmostEqual(0.6, model.B[model.state_index['hungry'], model.vocab.index("meow")])
+
+    # The bulk loader should build the same model as compiling the dicts
+    def test_bulk_load(self):
+        h = HMM()
+        h.load("partofspeech")
+        expected = CompiledModel.from_dicts(h.transitions, h.emissions)
+        self.assertEqual(expected.states, h.model.states)
+        self.assertEqual(list(expected.vocab), list(h.model.vocab))
+        np.testing.assert_array_equal(expected.pi, h.model.pi)
+        np.testing.assert_array_equal(expected.A, h.model.A)
+        np.testing.assert_array_equal(expected.B, h.model.B)
+
+    # A second load should map the binary cache, and editing a text file should rebuild it
+    def test_cache(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        basename = os.path.join(directory, "cat")
+        for ext in ("trans", "emit"):
+            shutil.copy(f"cat.{ext}", f"{basename}.{ext}")
+        HMM().load(basename)
+        h = HMM()
+        h.load(basename)
+        self.assertIsInstance(h.model.B, np.memmap)
+        self.assertAlmostEqual(0.6, h.model.B[h.model.state_index['hungry'], h.model.vocab.index('meow')])
+        # float32 gets a build of its own, mapped like the float64 one
+        for _ in range(2):
+            h32 = HMM(dtype=np.float32, profile=True)
+            h32.load(basename)
+        self.assertIsInstance(h32.model.B, np.memmap)
+        self.assertEqual(np.float32, h32.model.B.dtype)
+        self.assertTrue(h32.report()['caches']['binary_cache_mapped'])
+        # Opening a build as another dtype copies it into memory
+        build = os.path.dirname(h32.model.B.filename)
+        self.assertNotIsInstance(CompiledModel.open(build, np.float64).B, np.memmap)
+
+        with open(f"{basename}.emit", "w") as f:
+            f.write("happy silent 1.0\ngrumpy silent 1.0\nhungry meow 1.0\n")
+        h.load(basename)
+        self.assertEqual(['silent', 'meow'], list(h.model.vocab))
+        self.assertEqual(1, len([d for d in os.listdir(f"{basename}.hmmc") if d != "index.json"]))
+
+    # Batch decoding across worker processes should keep the input order
+    def test_viterbi_many(self):
+        h = HMM()
+        h.load("partofspeech")
+        sentences = list(read_sentences("ambiguous_sents.obs")) * 3
+        expected = [h.viterbi(s) for s in sentences]
+        self.assertEqual(expected, list(h.viterbi_many(sentences)))
+        self.assertEqual(expected, list(h.viterbi_many(sentences, processes=2, chunksize=4)))
+
+    # Batched Viterbi should agree with decoding one sequence at a time
+    def test_viterbi_batch(self):
+        h = HMM()
+        h.load("cat")
+        sequences = [['purr', 'silent', 'meow'], [], ['meow'], ['silent', 'silent', 'purr'], ['purr']]
+        paths, log_probs = h.viterbi_batch(sequences)
+        self.assertEqual([h.viterbi(s) for s in sequences], paths)
+        # happy -> happy -> hungry emitting purr, silent, meow
+        self.assertEqual(['happy', 'happy', 'hungry'], paths[0])
+        self.assertAlmostEqual(np.log(0.5 * 0.5 * 0.5 * 0.2 * 0.4 * 0.6), log_probs[0])
+
+    # The scaled forward pass should give the exact likelihood and normalized beliefs
+    def test_forward_filter(self):
+        h = HMM()
+        h.load("cat")
+        sequence = ['purr', 'silent', 'meow']
+        # Sum the probability of every hidden path by brute force
+        states = ['happy', 'grumpy', 'hungry']
+        total = 0.0
+        for path in itertools.product(states, repeat=len(sequence)):
+            p = float(h.transitions['#'][path[0]]) * float(h.emissions[path[0]][sequence[0]])
+            for prev, state, output in zip(path, path[1:], sequence[1:]):
+                p *= float(h.transitions[prev][state]) * float(h.emissions[state][output])
+            total += p
+        log_likelihood, beliefs = h.forward_filter(sequence)
+        self.assertAlmostEqual(np.log(total), log_likelihood)
+        np.testing.assert_allclose(np.ones(len(sequence)), beliefs.sum(axis=1))
+        self.assertEqual(states[int(np.argmax(beliefs[-1]))], h.forward(sequence))
+
+        # Pushing one observation at a time gives the same beliefs
+        belief = ForwardFilter(h)
+        for t, output in enumerate(sequence):
+            np.testing.assert_allclose(beliefs[t], belief.push(output))
+        self.assertAlmostEqual(log_likelihood, belief.log_likelihood)
+
+    # Long lander sequences must keep a finite likelihood
+    def test_forward_long_sequence(self):
+        h = HMM()
+        h.load("lander")
+        log_likelihood, beliefs = h.forward_filter(['1,1', '2,2', '3,3', '4,4'] + ['5,5'] * 2000)
+        self.assertTrue(np.isfinite(log_likelihood))
+        self.assertEqual('5,5', h.forward(['1,1', '2,2', '3,3', '4,4'] + ['5,5'] * 2000))
+
+    # Fixed-lag smoothing should match the exact posterior over the window
+    def test_streaming_filter(self):
+        h = HMM()
+        h.load("cat")
+        sequence = ['purr', 'silent', 'meow', 'meow']
+        states = ['happy', 'grumpy', 'hungry']
+        posterior = np.zeros((len(sequence), len(states)))
+        for path in itertools.product(range(len(states)), repeat=len(sequence)):
+            p = h.model.pi[path[0]] * h.model.B[path[0], h.model.vocab.index(sequence[0])]
+            for t in range(1, len(sequence)):
+                p *= h.model.A[path[t - 1], path[t]] * h.model.B[path[t], h.model.vocab.index(sequence[t])]
+            posterior[np.arange(len(sequence)), path] += p
+        posterior /= posterior.sum(axis=1, keepdims=True)
+
+        stream = StreamingFilter(h, lag=len(sequence) - 1)
+        steps = list(stream.run(sequence))
+        self.assertEqual([None] * (len(sequence) - 1), [s.smoothed for s in steps[:-1]])
+        np.testing.assert_allclose(posterior[0], steps[-1].smoothed)
+        np.testing.assert_allclose(posterior[1:], stream.flush())
+
+        # Async feeds give the same steps
+        async def feed():
+            for observation in sequence:
+                yield observation
+
+        async def collect():
+            return [s async for s in StreamingFilter(h).arun(feed())]
+
+        async_steps = asyncio.run(collect())
+        self.assertEqual([s.state for s in steps], [s.state for s in async_steps])
+
+    # Baum-Welch never lowers the likelihood, and its output reloads
+    def test_train(self):
+        h = HMM()
+        h.load("cat")
+        sequences = [['purr', 'silent', 'meow'], ['meow', 'meow'], ['silent', 'purr', 'purr', 'hiss']]
+        log_likelihood, posteriors = h.forward_backward(sequences[0])
+        self.assertAlmostEqual(h.forward_filter(sequences[0])[0], log_likelihood)
+        np.testing.assert_allclose(h.forward_filter(sequences[0])[1][-1], posteriors[-1])
+        np.testing.assert_allclose(np.ones(3), posteriors.sum(axis=1))
+
+        history = h.train(sequences, iterations=5, processes=2)
+        self.assertTrue(all(b >= a - 1e-9 for a, b in zip(history, history[1:])))
+        self.assertIn('hiss', h.model.vocab)
+        np.testing.assert_allclose(np.ones(3), h.model.B.sum(axis=1))
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        h.save(os.path.join(directory, "cat"))
+        reloaded = HMM()
+        reloaded.load(os.path.join(directory, "cat"), cache=False)
+        self.assertEqual(h.transitions, reloaded.transitions)
+        self.assertEqual(h.emissions, reloaded.emissions)
+        self.assertAlmostEqual(h.forward_backward(sequences[2])[0], reloaded.forward_backward(sequences[2])[0])
+
+    # The sparse backend decodes exactly like the dense one, in less memory
+    def test_sparse(self):
+        for name in ("cat", "lander", "partofspeech"):
+            dense = HMM()
+            dense.load(name, cache=False)
+            sparse = HMM(sparse=True)
+            sparse.load(name)
+            self.assertEqual(dense.transitions, sparse.transitions)
+            sequences = [dense.generate(12).outputseq for _ in range(10)]
+            paths, log_probs = dense.viterbi_batch(sequences)
+            sparse_paths, sparse_log_probs = sparse.viterbi_batch(sequences)
+            self.assertEqual(paths, sparse_paths)
+            np.testing.assert_allclose(log_probs, sparse_log_probs)
+            self.assertEqual(dense.forward(sequences[0]), sparse.forward(sequences[0]))
+        self.assertLess(sparse.model.nbytes, dense.model.B.nbytes)
+        for sentence in read_sentences("ambiguous_sents.obs"):
+            self.assertEqual(dense.viterbi(sentence), sparse.viterbi(sentence))
+        # Unknown words fall back to the dense answer
+        self.assertEqual(dense.viterbi(['the', 'zzz', 'dog']), sparse.viterbi(['the', 'zzz', 'dog']))
+        # Nor do the other algorithms build a dense emission table
+        sentence = ['the', 'dog', 'ran', '.']
+        self.assertEqual(dense.forward(sentence), sparse.forward(sentence))
+        self.assertEqual(dense.forward_filter(sentence)[0], sparse.forward_filter(sentence)[0])
+        self.assertEqual(dense.viterbi(sentence, beam=3), sparse.viterbi(sentence, beam=3))
+        self.assertEqual(dense.nbest(sentence, 3), sparse.nbest(sentence, 3))
+        self.assertEqual([s.outputseq for s in dense.generate_many(5, 8, seed=1)],
+                         [s.outputseq for s in sparse.generate_many(5, 8, seed=1)])
+        self.assertIsNone(sparse.model._dense)
+        self.assertLess(sparse.model.nbytes, dense.model.B.nbytes)
+
+    # N-best scores match brute force; a wide enough beam is exact
+    def test_beam_and_nbest(self):
+        h = HMM()
+        h.load("cat")
+        sequence = ['meow', 'purr', 'silent', 'meow']
+        scores = []
+        for path in itertools.product(['happy', 'grumpy', 'hungry'], repeat=len(sequence)):
+            p = float(h.transitions['#'][path[0]]) * float(h.emissions[path[0]][sequence[0]])
+            for prev, state, output in zip(path, path[1:], sequence[1:]):
+                p *= float(h.transitions[prev][state]) * float(h.emissions[state][output])
+            if p > 0:
+                scores.append(np.log(p))
+        best = h.nbest(sequence, 5)
+        np.testing.assert_allclose(sorted(scores, reverse=True)[:5], [log_prob for _, log_prob in best])
+        self.assertEqual(h.viterbi(sequence), best[0][0])
+        self.assertEqual(len(scores), len(h.nbest(sequence, 100)))
+
+        h = HMM()
+        h.load("partofspeech")
+        for sentence in read_sentences("ambiguous_sents.obs"):
+            self.assertEqual(h.viterbi(sentence), h.viterbi(sentence, beam=len(h.model.states)))
+            self.assertEqual(h.viterbi(sentence), h.viterbi(sentence, threshold=np.inf))
+            self.assertEqual(len(sentence), len(h.viterbi(sentence, beam=1, threshold=1.0)))
+
+    # Seeded bulk generation is reproducible and streams to .obs files
+    def test_generate_many(self):
+        h = HMM()
+        h.load("cat")
+        sequences = [str(s) for s in h.generate_many(100, 6, seed=7)]
+        self.assertEqual(sequences, [str(s) for s in h.generate_many(100, 6, seed=7, batch_size=9)])
+        self.assertNotEqual(sequences, [str(s) for s in h.generate_many(100, 6, seed=8)])
+        self.assertEqual(sequences[0], str(h.generate(6, seed=7)))
+        # Zero probabilities are never drawn: cats never start out hungry
+        self.assertTrue(all(s.stateseq[0] != 'hungry' for s in h.generate_many(500, 1, seed=1)))
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        h.write_sequences(os.path.join(directory, "cat.obs"), 100, 6, seed=7)
+        h.write_sequences(os.path.join(directory, "cat.tagged.obs"), 100, 6, seed=7, tagged=True)
+        self.assertEqual([s.split('\n')[1].split() for s in sequences],
+                         list(read_sentences(os.path.join(directory, "cat.obs"))))
+        with open(os.path.join(directory, "cat.tagged.obs")) as f:
+            self.assertEqual(''.join(sequences), f.read())
+
+    # Unseen words get emissions from their suffix and shape, so one of
+    # them no longer wipes out the whole trellis
+    def test_unknown_words(self):
+        h = HMM(unknown_words=True)
+        h.load("partofspeech")
+        sentence = ['the', 'blorfers', 'frobnicated', 'the', 'Zandor', 'in', '1987', '.']
+        self.assertEqual(['DET', 'NOUN', 'VERB', 'DET', 'NOUN', 'ADP', 'NUM', '.'], h.viterbi(sentence))
+        self.assertTrue(np.isfinite(h.forward_filter(sentence)[0]))
+        # A capitalized known word is looked up lowercased
+        self.assertEqual(h.model.column('the'), h.model.column('The'))
+        # Known words are tagged exactly as before
+        plain = HMM()
+        plain.load("partofspeech")
+        for sentence in read_sentences("ambiguous_sents.obs"):
+            self.assertEqual(plain.viterbi(sentence), h.viterbi(sentence))
+
+        sparse = HMM(sparse=True, unknown_words=True)
+        sparse.load("partofspeech")
+        self.assertEqual(h.viterbi(['Zandor', 'blorfed', '42', 'glorps']), sparse.viterbi(['Zandor', 'blorfed', '42', 'glorps']))
+
+    # Repeated sentences come from the decode cache, which stays bounded
+    def test_decode_cache(self):
+        h = HMM(decode_cache_size=2)
+        h.load("cat")
+        sequence = ['meow', 'purr', 'silent']
+        expected = h.viterbi(sequence)
+        self.assertEqual(tuple(expected), h.decode(tuple(sequence)))
+        self.assertEqual(['meow', 'purr', 'silent'], sequence)
+        self.assertEqual({'size': 1, 'maxsize': 2, 'hits': 1, 'misses': 1, 'evictions': 0, 'hit_rate': 0.5},
+                         h.decode_cache.stats())
+        # Changing a cached result doesn't change the cache
+        h.viterbi(sequence).append('happy')
+        self.assertEqual(expected, h.viterbi(sequence))
+
+        h.viterbi(['meow'])
+        h.viterbi(['purr'])
+        self.assertEqual(2, len(h.decode_cache))
+        self.assertEqual(1, h.decode_cache.evictions)
+
+        # Batches only decode what the cache hasn't seen, each sentence once
+        paths, log_probs = h.viterbi_batch([sequence, ['purr'], sequence])
+        uncached = HMM()
+        uncached.load("cat")
+        expected_paths, expected_log_probs = uncached.viterbi_batch([sequence, ['purr'], sequence])
+        self.assertEqual(expected_paths, paths)
+        np.testing.assert_allclose(expected_log_probs, log_probs)
+
+        # A newly loaded model never sees the old one's entries
+        misses = h.decode_cache.misses
+        h.load("cat")
+        h.viterbi(sequence)
+        self.assertEqual(misses + 1, h.decode_cache.misses)
+
+    # Profiling is off by default; when on, the hot paths report into it
+    def test_profile(self):
+        h = HMM()
+        h.load("cat")
+        self.assertIsNone(h.profile)
+        self.assertIsNone(h.report())
+
+        h = HMM(profile=True, decode_cache_size=4)
+        h.load("cat")
+        h.viterbi(['meow', 'purr', 'silent'])
+        h.viterbi_batch([['meow', 'woof'], ['purr', 'purr']])
+        h.forward(['meow', 'purr'])
+        list(h.generate_many(3, 5, seed=1))
+        report = json.loads(json.dumps(h.report()))
+        for phase in ('load', 'encode', 'emissions', 'dp', 'backtrace', 'forward', 'generate'):
+            self.assertGreater(report['phases'][phase]['calls'], 0)
+        self.assertEqual({'sentences': 3, 'tokens': 7, 'unknown_tokens': 1, 'dp_steps': 5,
+                          'forward_tokens': 2, 'generated_tokens': 15}, report['counters'])
+        self.assertEqual(3, report['caches']['decode_cache']['misses'])
+        h.profile.reset()
+        self.assertEqual({}, h.report()['phases'])
+
+    def test_server(self):
+        server = HMMServer(['cat'])
+        server.start()
+        try:
+            async def ask(*requests):
+                lines = [await server.respond(json.dumps(r)) for r in requests]
+                return [json.loads(line) for line in lines]
+            decoded, forward, generated, rejected, stats = asyncio.run(ask(
+                {'id': 7, 'tokens': ['meow', 'purr', 'silent']},
+                {'op': 'forward', 'text': 'meow purr'},
+                {'op': 'generate', 'n': 4, 'count': 2, 'seed': 1},
+                {'id': 'x', 'model': 'lander', 'tokens': ['meow']},
+                {'op': 'stats'}))
+        finally:
+            server.close()
+        h = HMM()
+        h.load("cat")
+        self.assertEqual(7, decoded['id'])
+        self.assertEqual(h.viterbi(['meow', 'purr', 'silent']), decoded['states'])
+        self.assertAlmostEqual(h.forward_filter(['meow', 'purr'])[0], forward['log_likelihood'])
+        self.assertEqual(2, len(generated['sequences']))
+        self.assertEqual(4, len(generated['sequences'][0]['outputs']))
+        self.assertEqual('x', rejected['id'])
+        self.assertIn('error', rejected)
+        self.assertEqual({'requests': 5, 'errors': 1, 'models': ['cat'], 'processes': 1}, stats)
+
+        # Requests from stdin redirected from a file, as with --serve - < requests.jsonl
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        requests = os.path.join(directory, 'requests.jsonl')
+        with open(requests, 'w') as f:
+            f.write('{"id": 1, "tokens": ["meow", "purr", "silent"]}\n{"id": 2, "text": "purr"}')
+        server = HMMServer(['cat'])
+        server.start()
+        stdin, stdout = sys.stdin, sys.stdout
+        try:
+            sys.stdin = open(requests)
+            sys.stdout = io.TextIOWrapper(io.BytesIO())
+            asyncio.run(server.serve('-'))
+            output = sys.stdout.buffer.getvalue()
+        finally:
+            sys.stdin.close()
+            sys.stdin, sys.stdout = stdin, stdout
+            server.close()
+        answers = {r['id']: r for r in map(json.loads, output.splitlines())}
+        self.assertEqual(h.viterbi(['meow', 'purr', 'silent']), answers[1]['states'])
+        self.assertEqual(h.viterbi(['purr']), answers[2]['states'])
+
+        # Two workers, each with every model loaded before its first request
+        server = HMMServer(['cat', 'lander'], processes=2, cache=False)
+        server.start()
+        try:
+            loaded = [server.executor.submit(_server_models).result() for _ in range(4)]
+        finally:
+            server.close()
+        self.assertEqual([['cat', 'lander']] * 4, loaded)
+
+    def test_server_socket(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'hmm.sock')
+            # Lines past asyncio's default 64 KiB limit are answered; one past
+            # the server's own limit gets an error and the next is answered
+            server = HMMServer(['cat'], line_limit=2 ** 18)
+            server.start()
+            try:
+                async def ask(*lines):
+                    serving = asyncio.ensure_future(server.serve(path))
+                    while not os.path.exists(path):
+                        await asyncio.sleep(0.01)
+                    reader, writer = await asyncio.open_unix_connection(path, limit=2 ** 20)
+                    answers = []
+                    for line in lines:
+                        writer.write(line.encode('utf-8') + b'\n')
+                        await writer.drain()
+                        answers.append(json.loads(await reader.readline()))
+                    writer.close()
+                    serving.cancel()
+                    return answers
+                batch = {'id': 1, 'sentences': [['meow', 'purr', 'silent']] * 5000}
+                big, oversized, small = asyncio.run(ask(
+                    json.dumps(batch), json.dumps({'id': 2, 'text': 'meow ' * 2 ** 16}),
+                    json.dumps({'id': 3, 'tokens': ['meow']})))
+            finally:
+                server.close()
+            self.assertEqual(5000, len(big['paths']))
+            self.assertNotIn('id', oversized)
+            self.assertIn('error', oversized)
+            self.assertEqual(3, small['id'])
+            self.assertEqual(['grumpy'], small['states'])
+            self.assertFalse(os.path.exists(path))
+
+            # A socket nobody listens on any more is removed
+            stale = socket.socket(socket.AF_UNIX)
+            stale.bind(path)
+            stale.close()
+            _remove_stale_socket(path)
+            self.assertFalse(os.path.exists(path))
+            # A live one is left to its server
+            live = socket.socket(socket.AF_UNIX)
+            live.bind(path)
+            live.listen()
+            try:
+                with self.assertRaises(OSError):
+                    _remove_stale_socket(path)
+                self.assertTrue(os.path.exists(path))
+            finally:
+                live.close()
+            os.unlink(path)
+            # So is anything that is not a socket
+            os.mkdir(path)
+            _remove_stale_socket(path)
+            self.assertTrue(os.path.isdir(path))
+        finally:
+            shutil.rmtree(directory)
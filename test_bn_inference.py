@@ -0,0 +1,112 @@
+import itertools
+from unittest import TestCase
+import numpy as np
+import pandas as pd
+from pgmpy.inference import VariableElimination
+from alarm import create_alarm_model
+from carnet import create_car_model
+from bn_inference import *
+
+class Test(TestCase):
+    # Every single-variable query with up to two pieces of evidence, from the
+    # joint and from the einsum contraction, against VariableElimination
+    def test_compiled_network(self):
+        for model in (create_alarm_model(), create_car_model()):
+            ve = VariableElimination(model)
+            for max_joint in (2 ** 20, 0):
+                net = CompiledNetwork(model, max_joint=max_joint)
+                self.assertEqual(max_joint == 0, net.joint is None)
+                self.assertAlmostEqual(1.0, net.probability({}))
+                for q in net.variables:
+                    others = [v for v in net.variables if v != q]
+                    for given in itertools.chain.from_iterable(itertools.combinations(others, k) for k in (0, 1, 2)):
+                        for states in itertools.product(*[net.state_names[v] for v in given]):
+                            evidence = dict(zip(given, states))
+                            expected = ve.query([q], evidence=evidence, show_progress=False)
+                            self.assertTrue(np.allclose(expected.values, net.query([q], evidence=evidence).values))
+
+        net = CompiledNetwork(create_car_model())
+        expected = VariableElimination(create_car_model()).query(["Moves", "Battery"], evidence={"Gas": "Empty"}, show_progress=False)
+        self.assertEqual(expected, net.query(["Moves", "Battery"], evidence={"Gas": "Empty"}))
+        self.assertAlmostEqual(0.3 * 0.99, net.probability({"Battery": "Doesn't work", "Radio": "Doesn't turn on"}))
+        with self.assertRaises(ValueError):
+            net.query(["Battery"], evidence={"Battery": "Works"})
+        with self.assertRaises(ValueError):
+            net.query(["Battery"], evidence={"Gas": "Half"})
+
+    def test_posterior_batch(self):
+        model = create_car_model()
+        ve = VariableElimination(model)
+        rng = np.random.default_rng(0)
+        records = pd.DataFrame({'Moves': rng.choice(['yes', 'no', None], 40),
+                                'Radio': rng.choice(["turns on", "Doesn't turn on"], 40)})
+        for max_joint in (2 ** 20, 0):
+            net = CompiledNetwork(model, max_joint=max_joint)
+            posteriors = net.posterior_batch(["Battery", "Gas"], records)
+            self.assertEqual((40, 4), posteriors.shape)
+            for row, posterior in zip(records.itertuples(index=False), posteriors):
+                evidence = {k: v for k, v in row._asdict().items() if pd.notna(v)}
+                expected = ve.query(["Battery", "Gas"], evidence=evidence, show_progress=False)
+                self.assertTrue(np.allclose(expected.values.ravel(), posterior))
+
+        # State indices, with -1 for missing, in a pool of two workers
+        codes = {'Moves': pd.Categorical(records['Moves'], ['yes', 'no']).codes.astype(int),
+                 'Radio': pd.Categorical(records['Radio'], ["turns on", "Doesn't turn on"]).codes.astype(int)}
+        self.assertTrue(np.allclose(posteriors, net.posterior_batch(["Battery", "Gas"], codes, processes=2, chunksize=16)))
+        # Indices with NaN for missing (how pandas stores ints with gaps), or nullable Int64
+        gappy = pd.DataFrame({'Moves': np.where(codes['Moves'] < 0, np.nan, codes['Moves']), 'Radio': codes['Radio']})
+        self.assertEqual('float64', gappy['Moves'].dtype)
+        self.assertTrue(np.allclose(posteriors, net.posterior_batch(["Battery", "Gas"], gappy)))
+        gappy['Moves'] = gappy['Moves'].astype('Int64')
+        self.assertTrue(np.allclose(posteriors, net.posterior_batch(["Battery", "Gas"], gappy)))
+        with self.assertRaises(ValueError):
+            net.posterior_batch(["Battery"], {'Moves': ['maybe']})
+        with self.assertRaises(ValueError):
+            net.posterior_batch(["Battery"], {'Moves': [0.5]})
+
+    def test_sample_posterior(self):
+        net = CompiledNetwork(create_car_model())
+        evidence = {"Moves": "no", "Radio": "turns on"}
+        exact = net.posterior(["Battery", "Gas"], evidence)
+        estimate = net.sample_posterior(["Battery", "Gas"], evidence, samples=200000, batch_size=50000, seed=1)
+        self.assertEqual(200000, estimate.samples)
+        self.assertTrue(np.allclose(exact, estimate.posterior, atol=0.01))
+        self.assertTrue(((estimate.low <= estimate.posterior) & (estimate.posterior <= estimate.high)).all())
+        self.assertLess(estimate.error(), 0.01)
+        # The same seed gives the same batches whichever process draws them
+        pooled = net.sample_posterior(["Battery", "Gas"], evidence, samples=200000, batch_size=50000, seed=1, processes=2)
+        self.assertTrue(np.array_equal(estimate.posterior, pooled.posterior))
+        # Forward sampling, stopping early
+        estimate = net.sample_posterior(["Starts"], samples=10 ** 7, batch_size=10000, seed=2, tolerance=0.01)
+        self.assertLess(estimate.samples, 10 ** 6)
+        self.assertLessEqual(estimate.error(), 0.01)
+        self.assertTrue(np.allclose(net.posterior(["Starts"]), estimate.posterior, atol=0.02))
+
+    def test_inference_session(self):
+        model = create_car_model()
+        ve = VariableElimination(model)
+        for max_joint in (2 ** 20, 0):
+            session = InferenceSession(CompiledNetwork(model, max_joint=max_joint), maxsize=4)
+            self.assertAlmostEqual(1.0, session.probability())
+            self.assertEqual(max_joint == 0, session.reduced is not None)
+            for variable, state in [("Radio", "turns on"), ("Gas", "Full"), ("Moves", "no")]:
+                session.observe(variable, state)
+                for q in ("Battery", "Starts"):
+                    expected = ve.query([q], evidence=session.evidence, show_progress=False)
+                    self.assertTrue(np.allclose(expected.values, session.posterior([q])))
+            session.forget("Gas")
+            expected = ve.query(["Battery", "KeyPresent"], evidence=session.evidence, show_progress=False)
+            self.assertTrue(np.allclose(expected.values, session.query(["Battery", "KeyPresent"]).values))
+            self.assertAlmostEqual(CompiledNetwork(model).probability(session.evidence), session.probability())
+            # Back to an earlier evidence set: memoized
+            session.observe("Gas", "Full")
+            hits = session.answers.hits
+            session.posterior(["Starts"])
+            self.assertEqual(hits + 1, session.answers.hits)
+            self.assertEqual(4, len(session.answers))
+            self.assertGreater(session.answers.evictions, 0)
+            with self.assertRaises(ValueError):
+                session.observe("Gas", "Half")
+            with self.assertRaises(ValueError):
+                session.posterior(["Gas"])
+            self.assertAlmostEqual(1.0, session.clear().probability())